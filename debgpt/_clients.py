@@ -0,0 +1,119 @@
+'''
+Copyright (C) 2024-2025 Mo Zhou <lumin@debian.org>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+from typing import Coroutine, Dict, Optional, Tuple, TypeVar
+import asyncio
+import atexit
+import hashlib
+import threading
+
+# (base_url, sha256(api_key)) -> OpenAI client. The digest is used as the key
+# so that the secret itself never ends up in the cache index.
+_OPENAI_CLIENTS: Dict[Tuple[Optional[str], str], object] = {}
+# (event loop, base_url, sha256(api_key)) -> AsyncOpenAI client
+_ASYNC_OPENAI_CLIENTS: Dict[Tuple[asyncio.AbstractEventLoop, Optional[str],
+                                  str], object] = {}
+_LOCK = threading.Lock()
+
+T = TypeVar('T')
+
+
+def _digest(api_key: Optional[str]) -> str:
+    return hashlib.sha256(str(api_key).encode()).hexdigest()
+
+
+def get_openai_client(base_url: Optional[str], api_key: Optional[str]):
+    '''
+    Return a process-wide OpenAI client for the given endpoint and key.
+    All frontend instances talking to the same endpoint share one client,
+    and hence one httpx connection pool.
+    '''
+    key = (base_url, _digest(api_key))
+    with _LOCK:
+        if key not in _OPENAI_CLIENTS:
+            import httpx
+            from openai import OpenAI
+            http_client = httpx.Client(limits=httpx.Limits(
+                max_connections=100, max_keepalive_connections=50))
+            _OPENAI_CLIENTS[key] = OpenAI(api_key=api_key,
+                                          base_url=base_url,
+                                          http_client=http_client)
+        return _OPENAI_CLIENTS[key]
+
+
+async def get_async_openai_client(base_url: Optional[str],
+                                  api_key: Optional[str]):
+    '''
+    Return the AsyncOpenAI client of the running event loop for the given
+    endpoint and key. The httpx connection pool of an async client is bound
+    to its loop, so every loop gets a client of its own. Run the loop with
+    run(...) to close its clients before the loop is closed.
+    '''
+    key = (asyncio.get_running_loop(), base_url, _digest(api_key))
+    with _LOCK:
+        if key not in _ASYNC_OPENAI_CLIENTS:
+            import httpx
+            from openai import AsyncOpenAI
+            http_client = httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=100, max_keepalive_connections=50))
+            _ASYNC_OPENAI_CLIENTS[key] = AsyncOpenAI(api_key=api_key,
+                                                     base_url=base_url,
+                                                     http_client=http_client)
+        return _ASYNC_OPENAI_CLIENTS[key]
+
+
+async def close_async_clients() -> None:
+    '''
+    Close the AsyncOpenAI clients of the running event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    with _LOCK:
+        keys = [key for key in _ASYNC_OPENAI_CLIENTS if key[0] is loop]
+        clients = [_ASYNC_OPENAI_CLIENTS.pop(key) for key in keys]
+    for client in clients:
+        await client.close()
+
+
+def run(main: Coroutine[object, object, T]) -> T:
+    '''
+    Run the coroutine like asyncio.run(...), and close the AsyncOpenAI
+    clients it created before the event loop is closed.
+    '''
+
+    async def _main() -> T:
+        try:
+            return await main
+        finally:
+            await close_async_clients()
+
+    return asyncio.run(_main())
+
+
+@atexit.register
+def close_clients() -> None:
+    '''
+    Close all the shared clients and release their connection pools. The
+    async clients of an event loop already closed cannot be closed any
+    more, and are only dropped. run(...) closes them before that.
+    '''
+    with _LOCK:
+        for client in _OPENAI_CLIENTS.values():
+            client.close()
+        _OPENAI_CLIENTS.clear()
+        for (loop, _, _), client in _ASYNC_OPENAI_CLIENTS.items():
+            if not loop.is_closed() and not loop.is_running():
+                loop.run_until_complete(client.close())
+        _ASYNC_OPENAI_CLIENTS.clear()
@@ -0,0 +1,40 @@
+'''
+Copyright (C) 2024-2025 Mo Zhou <lumin@debian.org>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import atexit
+import functools as ft
+import requests
+
+# (connect, read) timeout for the pooled HTTP session below
+HTTP_TIMEOUT = (10, 60)
+
+
+@ft.lru_cache(maxsize=1)
+def http_session() -> requests.Session:
+    '''
+    Return the process-wide HTTP session used by the URL readers.
+    Fetching many pages from the same host (e.g., ldo threads, or the
+    search results in read_google) then reuses the TCP and TLS connections
+    instead of paying a fresh handshake per request.
+    '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=16,
+                                            pool_maxsize=16)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # release the pooled sockets cleanly when the process exits
+    atexit.register(session.close)
+    return session
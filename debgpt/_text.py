@@ -0,0 +1,31 @@
+'''
+Copyright (C) 2024-2025 Mo Zhou <lumin@debian.org>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+def strip_trailing_space(text: str) -> str:
+    '''
+    strip the trailing whitespace of every line. A regex substitution would
+    backtrack quadratically over long runs of whitespace inside a line.
+    '''
+    return '\n'.join(x.rstrip() for x in text.split('\n'))
+
+
+def strip_space(text: str) -> str:
+    '''
+    strip the surrounding whitespace of every line, see strip_trailing_space
+    '''
+    return '\n'.join(x.strip() for x in text.split('\n'))
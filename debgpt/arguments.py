@@ -571,9 +571,78 @@ including buildd:<package>, bts:<number>, archwiki:<keyword>, man:<man>, cmd:<cm
     _g.add_argument('--mapreduce_parallelism',
                     type=int,
                     default=conf['mapreduce_parallelism'],
-                    help='number of parallel processes in mapreduce')
+                    help='number of parallel processes in mapreduce. 0 picks '
+                    'it from the CPU count, and from the latency of the first '
+                    'requests when --mapreduce_rpm is set')
     config_template = __add_arg_to_config(config_template, _g,
                                           'mapreduce_parallelism')
+    _g.add_argument('--mapreduce_token_budget',
+                    type=int,
+                    default=conf['mapreduce_token_budget'],
+                    help='maximum number of estimated tokens in flight in '
+                    'parallel mapreduce, e.g., the TPM limit of the service '
+                    'provider. 0 means unlimited')
+    config_template = __add_arg_to_config(config_template, _g,
+                                          'mapreduce_token_budget')
+    _g.add_argument('--mapreduce_batch_size',
+                    type=int,
+                    default=conf['mapreduce_batch_size'],
+                    help='number of chunks asked in a single map request, '
+                    'each answered separately. Only used by the binary map '
+                    'mode')
+    config_template = __add_arg_to_config(config_template, _g,
+                                          'mapreduce_batch_size')
+    _g.add_argument('--mapreduce_context_budget',
+                    type=int,
+                    default=conf['mapreduce_context_budget'],
+                    help='reduce all the remaining intermediate results in '
+                    'a single request once their total size in bytes fits '
+                    'in this budget. Only used by the binary reduce mode. 0 '
+                    'disables it')
+    config_template = __add_arg_to_config(config_template, _g,
+                                          'mapreduce_context_budget')
+    _g.add_argument('--mapreduce_reduce_fanout',
+                    type=int,
+                    default=conf['mapreduce_reduce_fanout'],
+                    help='number of intermediate results reduced in a single '
+                    'request. Larger values need fewer rounds of reduce '
+                    'requests. Only used by the binary reduce mode')
+    config_template = __add_arg_to_config(config_template, _g,
+                                          'mapreduce_reduce_fanout')
+    _g.add_argument('--mapreduce_rpm',
+                    type=int,
+                    default=conf['mapreduce_rpm'],
+                    help='pace the mapreduce requests below this Requests '
+                    'Per Minute limit. 0 is unlimited')
+    config_template = __add_arg_to_config(config_template, _g,
+                                          'mapreduce_rpm')
+    _g.add_argument('--mapreduce_tpm',
+                    type=int,
+                    default=conf['mapreduce_tpm'],
+                    help='pace the mapreduce requests below this Tokens Per '
+                    'Minute limit, estimated from the prompt length. 0 is '
+                    'unlimited')
+    config_template = __add_arg_to_config(config_template, _g,
+                                          'mapreduce_tpm')
+    _g.add_argument('--mapreduce_cache',
+                    type=str,
+                    default=conf['mapreduce_cache'],
+                    help='path to an on-disk cache of the mapreduce answers, '
+                    'e.g., ~/.debgpt/mapreduce_cache.sqlite. An interrupted '
+                    'mapreduce run resumes from the answers in it when run '
+                    'again. Empty disables it')
+    config_template = __add_arg_to_config(config_template, _g,
+                                          'mapreduce_cache')
+    _g.add_argument('--mapreduce_dedup',
+                    action=argparse.BooleanOptionalAction,
+                    default=conf['mapreduce_dedup'],
+                    help='skip the mapreduce chunks identical to an earlier '
+                    'chunk of the same file, e.g., repeated blocks of a build '
+                    'log')
+    config_template = __add_arg_to_config(config_template,
+                                          _g,
+                                          'mapreduce_dedup',
+                                          formatter=lambda x: str(x).lower())
 
     _g.add_argument('--mapreduce_map_mode',
                     type=str,
@@ -583,8 +652,9 @@ including buildd:<package>, bts:<number>, archwiki:<keyword>, man:<man>, cmd:<cm
     _g.add_argument('--mapreduce_reduce_mode',
                     type=str,
                     default='compact',
-                    choices=('compact', 'binary'),
-                    help='reduction mode for mapreduce')
+                    choices=('compact', 'binary', 'rolling'),
+                    help='reduction mode for mapreduce. "rolling" folds the '
+                    'chunks one by one into a running answer')
 
     # -- 999. The Question Template at the End of Prompt
     _g.add_argument('--ask',
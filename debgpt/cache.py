@@ -39,6 +39,10 @@ class Cache(dict):
         """
         self.connection: sqlite3.Connection = sqlite3.connect(db_name)
         self.cursor: sqlite3.Cursor = self.connection.cursor()
+        # WAL lets other processes read the cache while one of them writes,
+        # and synchronous=NORMAL avoids an fsync for every committed entry.
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute('PRAGMA synchronous=NORMAL')
         self._create_table()
         self._cleanup_expired()
 
@@ -24,7 +24,6 @@ from rich.rule import Rule
 from typing import Optional, Sequence
 import argparse
 import difflib
-import functools as ft
 import json
 import os
 import sys
@@ -231,11 +230,19 @@ def gather_information_ordered(msg: Optional[str], ag,
         msg = '' if msg is None else msg
         return msg + '\n' + info
 
+    # read all the --file specs concurrently ahead of time. They are
+    # appended below in the argument order.
+    files = iter(reader.read_many(list(ag.file)))
+
     # following the argument order, dispatch to reader.* functions with
     # different function signatures
     for key in ag_order:
         if key == 'mapreduce':
             spec = ag.mapreduce.pop(0)
+            cache = os.path.expanduser(ag.mapreduce_cache) or None
+            if cache is not None:
+                os.makedirs(os.path.dirname(os.path.abspath(cache)),
+                            exist_ok=True)
             aggregated = mapreduce.mapreduce_super_long_context(
                 spec,
                 ag.mapreduce_chunksize,
@@ -244,16 +251,24 @@ def gather_information_ordered(msg: Optional[str], ag,
                 ag.verbose,
                 ag.mapreduce_map_mode == 'compact',
                 ag.mapreduce_reduce_mode == 'compact',
-                parallelism=ag.mapreduce_parallelism)
+                parallelism=ag.mapreduce_parallelism,
+                rolling_mode=ag.mapreduce_reduce_mode == 'rolling',
+                token_budget=ag.mapreduce_token_budget,
+                map_batch_size=ag.mapreduce_batch_size,
+                context_budget=ag.mapreduce_context_budget,
+                rpm=ag.mapreduce_rpm,
+                tpm=ag.mapreduce_tpm,
+                reduce_fanout=ag.mapreduce_reduce_fanout,
+                cache=cache,
+                dedup=ag.mapreduce_dedup)
             msg = _append_info(msg, aggregated)
         elif key == 'retrieve':
             raise NotImplementedError(key)
         elif key == 'embed':
             raise NotImplementedError(key)
         elif key in ('file', ):
-            spec = getattr(ag, key).pop(0)
-            func = ft.partial(reader.read_and_wrap)
-            msg = _append_info(msg, func(spec))
+            getattr(ag, key).pop(0)
+            msg = _append_info(msg, next(files))
         elif key == 'inplace':
             # This is a special case. It reads the file as does by
             # `--file` (read-only), but `--inplace` (read-write) will write
@@ -66,6 +66,14 @@ class Config(object):
             # Mapreduce Settings
             'mapreduce_chunksize': 65536,
             'mapreduce_parallelism': 8,
+            'mapreduce_token_budget': 0,
+            'mapreduce_batch_size': 1,
+            'mapreduce_context_budget': 0,
+            'mapreduce_reduce_fanout': 2,
+            'mapreduce_rpm': 0,
+            'mapreduce_tpm': 0,
+            'mapreduce_cache': '',
+            'mapreduce_dedup': False,
             # OpenAI Frontend Specific
             'openai_base_url': 'https://api.openai.com/v1',
             'openai_model': 'gpt-4o',
@@ -14,18 +14,25 @@ GNU Lesser General Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
-from typing import List, Dict, Union, Optional
+from typing import List, Dict, Tuple, Union, Optional
 import argparse
 import os
 import json
 import uuid
+import getpass
 import sys
 import time
 import functools as ft
 import shlex
+import asyncio
+import concurrent.futures
+import queue
+import threading
 
 from prompt_toolkit import PromptSession
-from prompt_toolkit.completion import Completer, Completion
+from prompt_toolkit.application.current import get_app
+from prompt_toolkit.completion import ConditionalCompleter, WordCompleter
+from prompt_toolkit.filters import Condition
 from prompt_toolkit.styles import Style
 from rich.console import Console, Group
 from rich.live import Live
@@ -38,11 +45,24 @@ from rich.panel import Panel
 from rich.style import Style as richStyle
 
 from . import defaults
+from ._clients import get_openai_client, get_async_openai_client
 from .vector_service.client import VectorServiceClient
 
+try:
+    import orjson
+    _use_orjson = True
+except ImportError:
+    _use_orjson = False
+
 console = defaults.console
 console_stdout = Console()
 
+# the fixed parts of the system message carrying the retrieved snippets
+_VECTOR_CONTEXT_HEADER = (
+    'You have access to the following retrieved conversation snippets. '
+    'Use them to ground your response when relevant.')
+_VECTOR_CONTEXT_FOOTER = 'If none of the snippets apply, continue normally.'
+
 
 def _check(messages: List[Dict]):
     '''
@@ -84,6 +104,39 @@ def retry_ratelimit(func: callable,
     return wrapper
 
 
+def retry_ratelimit_async(func: callable,
+                          exception: Exception,
+                          retry_interval: int = 15):
+    '''
+    the coroutine counterpart of retry_ratelimit(...). It sleeps without
+    blocking the event loop, so that other requests can proceed meanwhile.
+    '''
+
+    @ft.wraps(func)
+    async def wrapper(*args, **kwargs):
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except exception:
+                console.log(
+                    f'Rate limit reached. Will retry after {retry_interval} seconds.'
+                )
+                await asyncio.sleep(retry_interval)
+
+    return wrapper
+
+
+@ft.lru_cache(maxsize=8)
+def _sampling_kwargs(temperature: Optional[float],
+                     top_p: Optional[float]) -> Tuple[Tuple[str, float], ...]:
+    '''
+    the user-provided sampling parameters, as (name, value) pairs.
+    '''
+    return tuple((key, value)
+                 for key, value in (('temperature', temperature),
+                                    ('top_p', top_p)) if value is not None)
+
+
 class AbstractFrontend():
     '''
     The frontend instance holds the whole chat session. The context is the whole
@@ -138,6 +191,19 @@ class AbstractFrontend():
         '''
         raise NotImplementedError('please override AbstractFrontend.oneshot()')
 
+    async def aoneshot(self, message: str) -> str:
+        '''
+        The asynchronous version of oneshot(), used by the concurrent
+        mapreduce. Frontends without a native async client fall back to
+        running the blocking oneshot() in a worker thread.
+
+        Args:
+            message: a string, the question.
+        Returns:
+            a string, the response text.
+        '''
+        return await asyncio.to_thread(self.oneshot, message)
+
     def query(self, messages: List[Dict]) -> str:
         '''
         Generate response text from the given chat history. This function
@@ -239,34 +305,40 @@ class AbstractFrontend():
         if not results:
             self._vector_context_prompt = None
             return
-        lines = [
-            'You have access to the following retrieved conversation snippets. '
-            'Use them to ground your response when relevant.',
-        ]
-        for idx, item in enumerate(results, start=1):
+
+        def _format(idx: int, item: Dict) -> str:
             role = item.get('role', 'unknown')
             score = item.get('score')
-            text = (item.get('text') or '').replace('\n', ' ').strip()
-            if len(text) > 512:
-                text = text[:509] + '...'
-            header = f'{role}'
-            if isinstance(score, (int, float)):
-                header += f' (score={score:.3f})'
-            lines.append(f'{idx}. {header}: {text}')
-        lines.append('If none of the snippets apply, continue normally.')
-        self._vector_context_prompt = '\n'.join(lines)
+            text = item.get('text') or ''
+            if text:
+                # only pay for the replace() copy when there is a newline
+                if '\n' in text:
+                    text = text.replace('\n', ' ')
+                text = text.strip()
+                if len(text) > 512:
+                    text = text[:509] + '...'
+            score_str = f' (score={score:.3f})' if isinstance(
+                score, (int, float)) else ''
+            return f'{idx}. {role}{score_str}: {text}'
+
+        snippets = '\n'.join(
+            _format(idx, item) for idx, item in enumerate(results, start=1))
+        self._vector_context_prompt = '\n'.join(
+            (_VECTOR_CONTEXT_HEADER, snippets, _VECTOR_CONTEXT_FOOTER))
 
     def _messages_for_llm(self) -> List[Dict[str, str]]:
-        base = list(self.session)
-        if not base or not self._vector_context_prompt:
-            return base
-        if base[-1].get('role') != 'user':
-            return base
+        # the returned list is only read by the callers, so there is no need
+        # to copy the session when nothing has to be injected.
+        session = self.session
+        if not session or not self._vector_context_prompt:
+            return session
+        if session[-1].get('role') != 'user':
+            return session
         injected = {
             'role': 'system',
             'content': self._vector_context_prompt,
         }
-        return base[:-1] + [injected, base[-1]]
+        return [*session[:-1], injected, session[-1]]
 
 
 class EchoFrontend(AbstractFrontend):
@@ -349,12 +421,12 @@ class OpenAIFrontend(AbstractFrontend):
     def __init__(self, args):
         super().__init__(args)
         try:
-            from openai import OpenAI
+            import openai  # noqa: F401
         except ImportError:
             console.log('please install OpenAI package: "pip install openai"')
             exit(1)
-        self.client = OpenAI(api_key=args.openai_api_key,
-                             base_url=args.openai_base_url)
+        self.client = get_openai_client(args.openai_base_url,
+                                        args.openai_api_key)
         self.model = args.openai_model
     # GitHub Copilot: runtime detection for sampling parameter support.
     # Track whether the backend has confirmed support for sampling params.
@@ -364,9 +436,7 @@ class OpenAIFrontend(AbstractFrontend):
             self.session.append(
                 {"role": "system", "content": args.system_message})
             # GitHub Copilot: collect user-provided sampling params once per session.
-            self.kwargs = self._collect_sampling_kwargs(args)
-            if not self.kwargs:
-                self._sampling_params_supported = False
+            self._init_sampling_kwargs(args)
         else:
             self.kwargs = {}
             self._sampling_params_supported = False
@@ -381,13 +451,15 @@ class OpenAIFrontend(AbstractFrontend):
 
     # GitHub Copilot: helper to gather sampling kwargs while we probe API support.
     def _collect_sampling_kwargs(self, args) -> Dict[str, float]:
-        sampling_kwargs: Dict[str, float] = {}
-        for key in ('temperature', 'top_p'):
-            if hasattr(args, key):
-                value = getattr(args, key)
-                if value is not None:
-                    sampling_kwargs[key] = value
-        return sampling_kwargs
+        # a fresh dict, because unsupported params are popped from it later
+        return dict(
+            _sampling_kwargs(getattr(args, 'temperature', None),
+                             getattr(args, 'top_p', None)))
+
+    def _init_sampling_kwargs(self, args) -> None:
+        # nothing to probe when the server defaults are used anyway
+        self.kwargs = self._collect_sampling_kwargs(args)
+        self._sampling_params_supported = None if self.kwargs else False
 
     # GitHub Copilot: strip unsupported sampling params and retry once detected.
     def _handle_sampling_error(self, exc: Exception) -> bool:
@@ -417,42 +489,82 @@ class OpenAIFrontend(AbstractFrontend):
             self._sampling_params_supported = None
         return True
 
-    # GitHub Copilot: centralize create() calls so retries happen transparently.
+    # The sync and async create() calls below share the handling of the
+    # sampling params, so that retries happen transparently for both.
+    def _request_kwargs(self, kwargs: Dict) -> Dict:
+        if self.kwargs and self._sampling_params_supported is False:
+            # Sampling params were disabled previously; re-evaluate in case
+            # they were reassigned.
+            self._sampling_params_supported = None
+        request_kwargs = dict(kwargs)
+        if self.kwargs and self._sampling_params_supported is not False:
+            request_kwargs.update(self.kwargs)
+        return request_kwargs
+
+    def _retry_without_sampling(self, exc: Exception) -> bool:
+        return bool(self.kwargs and
+                    self._sampling_params_supported is not False and
+                    self._handle_sampling_error(exc))
+
+    def _request_succeeded(self) -> None:
+        if self.kwargs:
+            self._sampling_params_supported = True
+
     def _chat_completions_create(self, **kwargs):
         while True:
-            if self.kwargs and self._sampling_params_supported is False:
-                # Sampling params were disabled previously; re-evaluate in case they were reassigned.
-                self._sampling_params_supported = None
-            request_kwargs = dict(kwargs)
-            if self.kwargs and self._sampling_params_supported is not False:
-                request_kwargs.update(self.kwargs)
             try:
                 completion = self.client.chat.completions.create(
-                    **request_kwargs)
+                    **self._request_kwargs(kwargs))
             except Exception as exc:
-                if self.kwargs and self._sampling_params_supported is not False and self._handle_sampling_error(exc):
+                if self._retry_without_sampling(exc):
                     continue
                 raise
-            else:
-                if self.kwargs:
-                    self._sampling_params_supported = True
-                return completion
+            self._request_succeeded()
+            return completion
+
+    async def _achat_completions_create(self, **kwargs):
+        # one client per event loop, closed by _clients.run(...)
+        client = await get_async_openai_client(str(self.client.base_url),
+                                               self.client.api_key)
+        while True:
+            try:
+                completion = await client.chat.completions.create(
+                    **self._request_kwargs(kwargs))
+            except Exception as exc:
+                if self._retry_without_sampling(exc):
+                    continue
+                raise
+            self._request_succeeded()
+            return completion
+
+    def _oneshot_kwargs(self, message: str) -> Dict:
+        return dict(model=self.model,
+                    messages=[{
+                        "role": "user",
+                        "content": message
+                    }],
+                    stream=False)
 
     def oneshot(self, message: str) -> str:
 
         def _func() -> str:
             completions = self._chat_completions_create(
-                model=self.model,
-                messages=[{
-                    "role": "user",
-                    "content": message
-                }],
-                stream=False)
+                **self._oneshot_kwargs(message))
             return completions.choices[0].message.content
 
         from openai import RateLimitError
         return retry_ratelimit(_func, RateLimitError)()
 
+    async def aoneshot(self, message: str) -> str:
+
+        async def _func() -> str:
+            completions = await self._achat_completions_create(
+                **self._oneshot_kwargs(message))
+            return completions.choices[0].message.content
+
+        from openai import RateLimitError
+        return await retry_ratelimit_async(_func, RateLimitError)()
+
     def query(self, messages: Union[List, Dict, str]) -> list:
         # add the message into the session
         self.update_session(messages)
@@ -716,14 +828,12 @@ class XAIFrontend(OpenAIFrontend):
 
     def __init__(self, args):
         super().__init__(args)
-        from openai import OpenAI
-        self.client = OpenAI(api_key=args.xai_api_key,
-                             base_url='https://api.x.ai/v1/')
+        self.client = get_openai_client('https://api.x.ai/v1/',
+                                        args.xai_api_key)
         self.session.append({"role": "system", "content": args.system_message})
         self.model = args.xai_model
     # GitHub Copilot: reuse helper so sampling params degrade gracefully.
-        self.kwargs = self._collect_sampling_kwargs(args)
-        self._sampling_params_supported = None if self.kwargs else False
+        self._init_sampling_kwargs(args)
         if args.verbose:
             if self.kwargs:
                 console.log(f'{self.NAME}> model={repr(self.model)}, ' +
@@ -743,14 +853,12 @@ class NvidiaFrontend(OpenAIFrontend):
 
     def __init__(self, args):
         super().__init__(args)
-        from openai import OpenAI
-        self.client = OpenAI(api_key=args.nvidia_api_key,
-                             base_url=args.nvidia_base_url)
+        self.client = get_openai_client(args.nvidia_base_url,
+                                        args.nvidia_api_key)
         self.session.append({"role": "system", "content": args.system_message})
         self.model = args.nvidia_model
     # GitHub Copilot: reuse helper so sampling params degrade gracefully.
-        self.kwargs = self._collect_sampling_kwargs(args)
-        self._sampling_params_supported = None if self.kwargs else False
+        self._init_sampling_kwargs(args)
         if args.verbose:
             if self.kwargs:
                 console.log(f'{self.NAME}> model={repr(self.model)}, ' +
@@ -769,14 +877,12 @@ class LlamafileFrontend(OpenAIFrontend):
 
     def __init__(self, args):
         AbstractFrontend.__init__(self, args)
-        from openai import OpenAI
-        self.client = OpenAI(api_key='no-key-required',
-                             base_url=args.llamafile_base_url)
+        self.client = get_openai_client(args.llamafile_base_url,
+                                        'no-key-required')
         self.session.append({"role": "system", "content": args.system_message})
         self.model = 'llamafile from https://github.com/Mozilla-Ocho/llamafile'
     # GitHub Copilot: reuse helper so sampling params degrade gracefully.
-        self.kwargs = self._collect_sampling_kwargs(args)
-        self._sampling_params_supported = None if self.kwargs else False
+        self._init_sampling_kwargs(args)
         if args.verbose:
             if self.kwargs:
                 console.log(f'{self.NAME}> model={repr(self.model)}, ' +
@@ -795,14 +901,12 @@ class OllamaFrontend(OpenAIFrontend):
 
     def __init__(self, args):
         AbstractFrontend.__init__(self, args)
-        from openai import OpenAI
-        self.client = OpenAI(api_key='no-key-required',
-                             base_url=args.ollama_base_url)
+        self.client = get_openai_client(args.ollama_base_url,
+                                        'no-key-required')
         self.session.append({"role": "system", "content": args.system_message})
         self.model = args.ollama_model
     # GitHub Copilot: reuse helper so sampling params degrade gracefully.
-        self.kwargs = self._collect_sampling_kwargs(args)
-        self._sampling_params_supported = None if self.kwargs else False
+        self._init_sampling_kwargs(args)
         if args.verbose:
             if self.kwargs:
                 console.log(f'{self.NAME}> model={repr(self.model)}, ' +
@@ -821,14 +925,12 @@ class LlamacppFrontend(OpenAIFrontend):
 
     def __init__(self, args):
         AbstractFrontend.__init__(self, args)
-        from openai import OpenAI
-        self.client = OpenAI(api_key='no-key-required',
-                             base_url=args.llamacpp_base_url)
+        self.client = get_openai_client(args.llamacpp_base_url,
+                                        'no-key-required')
         self.session.append({"role": "system", "content": args.system_message})
         self.model = 'model-is-specified-at-the-llama-server-arguments'
     # GitHub Copilot: reuse helper so sampling params degrade gracefully.
-        self.kwargs = self._collect_sampling_kwargs(args)
-        self._sampling_params_supported = None if self.kwargs else False
+        self._init_sampling_kwargs(args)
         if args.verbose:
             if self.kwargs:
                 console.log(f'{self.NAME}> ' +
@@ -847,9 +949,8 @@ class DeepSeekFrontend(OpenAIFrontend):
 
     def __init__(self, args):
         AbstractFrontend.__init__(self, args)
-        from openai import OpenAI
-        self.client = OpenAI(api_key=args.deepseek_api_key,
-                             base_url=args.deepseek_base_url)
+        self.client = get_openai_client(args.deepseek_base_url,
+                                        args.deepseek_api_key)
         if args.deepseek_model not in ('deepseek-reasoner'):
             # see the usage recommendations at
             # https://huggingface.co/deepseek-ai/DeepSeek-R1
@@ -857,8 +958,7 @@ class DeepSeekFrontend(OpenAIFrontend):
                 {"role": "system", "content": args.system_message})
         self.model = args.deepseek_model
         # GitHub Copilot: reuse helper so sampling params degrade gracefully.
-        self.kwargs = self._collect_sampling_kwargs(args)
-        self._sampling_params_supported = None if self.kwargs else False
+        self._init_sampling_kwargs(args)
         if args.verbose:
             if self.kwargs:
                 console.log(f'{self.NAME}> model={repr(self.model)}, ' +
@@ -877,14 +977,12 @@ class vLLMFrontend(OpenAIFrontend):
 
     def __init__(self, args):
         AbstractFrontend.__init__(self, args)
-        from openai import OpenAI
-        self.client = OpenAI(api_key='your-vllm-api-key',
-                             base_url=args.vllm_base_url)
+        self.client = get_openai_client(args.vllm_base_url,
+                                        'your-vllm-api-key')
         self.session.append({"role": "system", "content": args.system_message})
         self.model = args.vllm_model
     # GitHub Copilot: reuse helper so sampling params degrade gracefully.
-        self.kwargs = self._collect_sampling_kwargs(args)
-        self._sampling_params_supported = None if self.kwargs else False
+        self._init_sampling_kwargs(args)
         if args.verbose:
             console.log(f'{self.NAME}> model={repr(self.model)}, ' +
                         f'temperature={args.temperature}, top_p={args.top_p}.')
@@ -899,11 +997,29 @@ class ZMQFrontend(AbstractFrontend):
     stream: bool = False
 
     def __init__(self, args):
-        import zmq
         super().__init__(args)
         self.zmq_backend = args.zmq_backend
-        self.socket = zmq.Context().socket(zmq.REQ)
-        self.socket.connect(self.zmq_backend)
+        # The DEALER socket is owned by the I/O thread, because ZMQ sockets
+        # must not be shared across threads. Requests are handed over through
+        # the outbox and correlated with their replies by a request id, so
+        # that concurrent callers (e.g., the parallel mapreduce) can have
+        # several requests in flight at the same time. The I/O thread blocks
+        # in poll() until a reply arrives or a caller wakes it up through the
+        # inproc PAIR sockets.
+        import zmq
+        context = zmq.Context.instance()
+        self._socket = context.socket(zmq.DEALER)
+        self._socket.connect(self.zmq_backend)
+        wakeup = f'inproc://debgpt-zmq-wakeup-{uuid.uuid4().hex}'
+        self._wakeup_rx = context.socket(zmq.PAIR)
+        self._wakeup_rx.bind(wakeup)
+        self._wakeup_tx = context.socket(zmq.PAIR)
+        self._wakeup_tx.connect(wakeup)
+        self._wakeup_lock = threading.Lock()
+        self._outbox: queue.Queue = queue.Queue()
+        self._pending: Dict[bytes, concurrent.futures.Future] = {}
+        self._io_thread = threading.Thread(target=self._io_loop, daemon=True)
+        self._io_thread.start()
         console.log(
             f'{self.NAME}> Connected to ZMQ backend {self.zmq_backend}.')
         #
@@ -913,18 +1029,79 @@ class ZMQFrontend(AbstractFrontend):
         if hasattr(args, 'top_p'):
             console.log('warning! --top_p not yet supported for this frontend')
 
-    def query(self, content: Union[List, Dict, str]) -> list:
-        self.update_session(content)
-        baseline_len = len(self.session)
-        request_messages = self._messages_for_llm()
-        msg_json = json.dumps(request_messages)
+    def _io_loop(self) -> None:
+        import zmq
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        poller.register(self._wakeup_rx, zmq.POLLIN)
+        while True:
+            events = dict(poller.poll())
+            if self._wakeup_rx in events:
+                if self._wakeup_rx.recv() == b'close':
+                    break
+                while True:
+                    try:
+                        self._socket.send_multipart(self._outbox.get_nowait())
+                    except queue.Empty:
+                        break
+            if self._socket in events:
+                # the REP backend echoes the envelope back: [id, b'', reply]
+                req_id, _, msg = self._socket.recv_multipart()
+                future = self._pending.pop(req_id, None)
+                if future is not None:
+                    future.set_result(msg)
+        self._socket.close(linger=0)
+        self._wakeup_rx.close(linger=0)
+
+    def _wakeup(self, signal: bytes) -> None:
+        # the PAIR socket is shared by the calling threads
+        with self._wakeup_lock:
+            self._wakeup_tx.send(signal)
+
+    def close(self) -> None:
+        '''
+        Stop the I/O thread and close the sockets. The requests still in
+        flight fail with a ConnectionError.
+        '''
+        if not self._io_thread.is_alive():
+            return
+        self._wakeup(b'close')
+        self._io_thread.join()
+        with self._wakeup_lock:
+            self._wakeup_tx.close(linger=0)
+        for future in self._pending.values():
+            future.set_exception(ConnectionError('ZMQ frontend closed'))
+        self._pending.clear()
+
+    def _request(self, messages: List[Dict]) -> List[Dict]:
+        # orjson serializes straight to bytes and parses from bytes, which
+        # saves an encode/decode round of every (potentially long) session.
+        if _use_orjson:
+            msg_json = orjson.dumps(messages)
+        else:
+            msg_json = json.dumps(messages).encode()
         if self.debug:
             console.log('send:', msg_json)
-        self.socket.send_string(msg_json)
-        msg = self.socket.recv()
-        new_session = json.loads(msg)
+        req_id = uuid.uuid4().bytes
+        future = concurrent.futures.Future()
+        self._pending[req_id] = future
+        self._outbox.put([req_id, b'', msg_json])
+        self._wakeup(b'send')
+        if _use_orjson:
+            new_session = orjson.loads(future.result())
+        else:
+            new_session = json.loads(future.result())
         _check(new_session)
-        self.session = new_session
+        return new_session
+
+    def oneshot(self, message: str) -> str:
+        new_session = self._request([{'role': 'user', 'content': message}])
+        return new_session[-1]['content']
+
+    def query(self, content: Union[List, Dict, str]) -> list:
+        self.update_session(content)
+        baseline_len = len(self.session)
+        self.session = self._request(self._messages_for_llm())
         if len(self.session) > baseline_len:
             for message in self.session[baseline_len:]:
                 self._vector_after_append(message)
@@ -933,61 +1110,58 @@ class ZMQFrontend(AbstractFrontend):
         return self.session[-1]['content']
 
 
+def _username_from_pwd() -> str:
+    import pwd
+    return pwd.getpwuid(os.getuid())[0]
+
+
+# ordered probes for the user name. The first non-empty answer wins.
+_USERNAME_PROBES = (
+    getpass.getuser,
+    _username_from_pwd,
+    os.getlogin,
+)
+
+
+@ft.lru_cache(maxsize=1)
 def get_username():
-    try:
-        import getpass
-        return getpass.getuser()
-    except Exception:
-        pass
-    try:
-        import pwd
-        return pwd.getpwuid(os.getuid())[0]
-    except Exception:
-        pass
-    try:
-        return os.getlogin()
-    except Exception:
-        pass
-    # common shell env
-    for env in ('USER', 'USERNAME', 'LOGNAME'):
-        if u := os.environ.get(env):
-            return u
-    # final fallback
-    return 'user'
+    for probe in _USERNAME_PROBES:
+        try:
+            if username := probe():
+                return username
+        except Exception:
+            pass
+    # common shell env, then the final fallback
+    return next((os.environ[env] for env in ('USER', 'USERNAME', 'LOGNAME')
+                 if os.environ.get(env)), 'user')
+
+
+# frontend name (--frontend) -> frontend class. Third-party frontends can be
+# plugged in by adding an entry here.
+_FRONTEND_REGISTRY: Dict[str, type] = {
+    'zmq': ZMQFrontend,
+    'openai': OpenAIFrontend,
+    'anthropic': AnthropicFrontend,
+    'google': GoogleFrontend,
+    'xai': XAIFrontend,
+    'nvidia': NvidiaFrontend,
+    'llamafile': LlamafileFrontend,
+    'ollama': OllamaFrontend,
+    'llamacpp': LlamacppFrontend,
+    'deepseek': DeepSeekFrontend,
+    'vllm': vLLMFrontend,
+    'echo': EchoFrontend,
+    'vectorecho': VectorEchoFrontend,
+}
 
 
 def create_frontend(args):
-    if args.frontend == 'zmq':
-        frontend = ZMQFrontend(args)
-    elif args.frontend == 'openai':
-        frontend = OpenAIFrontend(args)
-    elif args.frontend == 'anthropic':
-        frontend = AnthropicFrontend(args)
-    elif args.frontend == 'google':
-        frontend = GoogleFrontend(args)
-    elif args.frontend == 'xai':
-        frontend = XAIFrontend(args)
-    elif args.frontend == 'nvidia':
-        frontend = NvidiaFrontend(args)
-    elif args.frontend == 'llamafile':
-        frontend = LlamafileFrontend(args)
-    elif args.frontend == 'ollama':
-        frontend = OllamaFrontend(args)
-    elif args.frontend == 'llamacpp':
-        frontend = LlamacppFrontend(args)
-    elif args.frontend == 'deepseek':
-        frontend = DeepSeekFrontend(args)
-    elif args.frontend == 'vllm':
-        frontend = vLLMFrontend(args)
-    elif args.frontend == 'dryrun':
-        frontend = None
-    elif args.frontend == 'echo':
-        frontend = EchoFrontend(args)
-    elif args.frontend == 'vectorecho':
-        frontend = VectorEchoFrontend(args)
-    else:
+    if args.frontend == 'dryrun':
+        return None
+    cls = _FRONTEND_REGISTRY.get(args.frontend)
+    if cls is None:
         raise NotImplementedError
-    return frontend
+    return cls(args)
 
 
 def interact_once(f: AbstractFrontend, text: str) -> None:
@@ -1012,6 +1186,15 @@ def interact_once(f: AbstractFrontend, text: str) -> None:
             _ = f(text)
 
 
+# Complete the slash commands, only when the input starts with '/'.
+# sentence=True matches against the whole input instead of the last word,
+# since '/' is not a word character.
+_SLASH_COMPLETER = ConditionalCompleter(
+    WordCompleter(['/quit', '/save', '/reset'], sentence=True),
+    filter=Condition(lambda: get_app().current_buffer.document.
+                     text_before_cursor.startswith('/')))
+
+
 def interact_with(f: AbstractFrontend) -> None:
     # create prompt_toolkit style
     if f.monochrome:
@@ -1020,27 +1203,10 @@ def interact_with(f: AbstractFrontend) -> None:
         prompt_style = Style([('prompt', 'bold fg:ansibrightcyan'),
                               ('', 'bold ansiwhite')])
 
-    # Completer with several keywords keywords to be completed
-    class CustomCompleter(Completer):
-
-        def get_completions(self, document, complete_event):
-            # Get the current text before the cursor
-            text_before_cursor = document.text_before_cursor
-
-            # Check if the text starts with '/'
-            if text_before_cursor.startswith('/'):
-                # Define the available keywords
-                keywords = ['/quit', '/save', '/reset']
-
-                # Generate completions for each keyword
-                for keyword in keywords:
-                    if keyword.startswith(text_before_cursor):
-                        yield Completion(keyword, -len(text_before_cursor))
-
     # start prompt session
     prompt_session = PromptSession(style=prompt_style,
                                    multiline=f.multiline,
-                                   completer=CustomCompleter())
+                                   completer=_SLASH_COMPLETER)
 
     # if multiline is enabled, print additional help message
     if f.multiline:
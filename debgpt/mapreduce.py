@@ -14,40 +14,387 @@ GNU Lesser General Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
-from typing import List, Optional
+from typing import List, Dict, Iterable, Optional, Awaitable, Tuple, Callable
 import argparse
+import asyncio
+import concurrent.futures
 import functools as ft
+import hashlib
+import itertools
+import json
+import os
+import re
 import sys
-import concurrent.futures
-import textwrap
-from rich.progress import track
-from rich.rule import Rule
+import threading
+import time
+import tenacity
+from rich.progress import track, Progress
 from . import reader
 from .reader import Entry
-from .defaults import console
+from .defaults import console, HOME
+from .cache import Cache
 from . import frontend
+from . import _clients
 
 _VERBOSE_WRAP_LENGTH = 512
 
 
+def estimate_tokens(text: str) -> int:
+    '''
+    rough number of tokens in the text. One token is about four characters
+    of English text for the common BPE tokenizers.
+    '''
+    return len(text) // 4 + 1
+
+
+class TokenBudgetLimiter:
+    '''
+    Admit LLM requests until the estimated number of in-flight tokens reaches
+    the budget, e.g., the Token Per Minute (TPM) limit of the service
+    provider. Small requests are packed densely, while large ones do not
+    overflow the budget and trigger rate limit retries. A request larger
+    than the whole budget is admitted alone.
+    '''
+
+    def __init__(self, budget: int) -> None:
+        assert budget > 0
+        self.budget = budget
+        self.used = 0
+        self._cond: Optional[asyncio.Condition] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _condition(self) -> asyncio.Condition:
+        # asyncio primitives are bound to one event loop, while each of the
+        # synchronous stage entries, e.g., map_parallel, runs its own loop.
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._cond = asyncio.Condition()
+            self._loop = loop
+        return self._cond
+
+    async def acquire(self, ntokens: int) -> int:
+        ntokens = min(ntokens, self.budget)
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self.used + ntokens <= self.budget)
+            self.used += ntokens
+        return ntokens
+
+    async def release(self, ntokens: int) -> None:
+        cond = self._condition()
+        async with cond:
+            self.used -= ntokens
+            cond.notify_all()
+
+
+class BudgetedFrontend:
+    '''
+    Wrap a frontend so that concurrent queries are admitted by a
+    TokenBudgetLimiter. Serial queries go straight to the frontend.
+    '''
+
+    def __init__(self, frtnd: frontend.AbstractFrontend,
+                 limiter: TokenBudgetLimiter) -> None:
+        self.frtnd = frtnd
+        self.limiter = limiter
+
+    def __getattr__(self, name: str):
+        return getattr(self.frtnd, name)
+
+    async def aoneshot(self, message: str) -> str:
+        ntokens = await self.limiter.acquire(estimate_tokens(message))
+        try:
+            return await self.frtnd.aoneshot(message)
+        finally:
+            await self.limiter.release(ntokens)
+
+
+class RateLimiter:
+    '''
+    Token bucket limiter of the Requests Per Minute (RPM) and the Tokens Per
+    Minute (TPM). Both buckets refill continuously. A request reserves its
+    share before submission and then waits until the buckets have refilled,
+    instead of being rejected by the service provider and retried with
+    backoff. Reservations may overdraw the buckets, so that the waiting
+    requests are released in order. 0 means unlimited. The clock returns
+    the current time in seconds.
+    '''
+
+    def __init__(self, rpm: int = 0, tpm: int = 0,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._clock = clock
+        self._stamp = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, ntokens: int) -> float:
+        '''
+        reserve one request of ntokens, and return the seconds to wait
+        before submitting it.
+        '''
+        with self._lock:
+            now = self._clock()
+            elapsed, self._stamp = now - self._stamp, now
+            delay = 0.0
+            if self.rpm > 0:
+                self._requests = min(self.rpm, self._requests +
+                                     elapsed * self.rpm / 60) - 1
+                delay = max(delay, -60 * self._requests / self.rpm)
+            if self.tpm > 0:
+                self._tokens = min(self.tpm, self._tokens +
+                                   elapsed * self.tpm / 60) - min(
+                                       ntokens, self.tpm)
+                delay = max(delay, -60 * self._tokens / self.tpm)
+            return delay
+
+    def acquire(self, ntokens: int) -> None:
+        time.sleep(self.reserve(ntokens))
+
+    async def aacquire(self, ntokens: int) -> None:
+        await asyncio.sleep(self.reserve(ntokens))
+
+
+class RateLimitedFrontend:
+    '''
+    Wrap a frontend so that both serial and concurrent queries are paced by
+    a RateLimiter.
+    '''
+
+    def __init__(self, frtnd: frontend.AbstractFrontend,
+                 limiter: RateLimiter) -> None:
+        self.frtnd = frtnd
+        self.limiter = limiter
+
+    def __getattr__(self, name: str):
+        return getattr(self.frtnd, name)
+
+    def oneshot(self, message: str) -> str:
+        self.limiter.acquire(estimate_tokens(message))
+        return self.frtnd.oneshot(message)
+
+    async def aoneshot(self, message: str) -> str:
+        await self.limiter.aacquire(estimate_tokens(message))
+        return await self.frtnd.aoneshot(message)
+
+
+def _log_retry(retry_state: tenacity.RetryCallState) -> None:
+    console.log(
+        f'MapReduce> {repr(retry_state.outcome.exception())}. Retrying '
+        f'(attempt {retry_state.attempt_number}) after '
+        f'{retry_state.next_action.sleep:.1f} seconds.')
+
+
+def _is_transient(exc: BaseException) -> bool:
+    # openai takes most of the import time, and it is only loaded by the
+    # frontends that talk to it. Its errors cannot be raised before that.
+    openai = sys.modules.get('openai')
+    return openai is not None and isinstance(
+        exc, (openai.RateLimitError, openai.APIConnectionError,
+              openai.APITimeoutError))
+
+
+# Retry a map or reduce step on transient service failures, with exponential
+# backoff and jitter, so that one failed request does not abort the whole
+# mapreduce. Rate limits are mostly handled by the frontends already.
+retry_transient = tenacity.retry(
+    wait=tenacity.wait_random_exponential(min=1, max=60),
+    stop=tenacity.stop_after_attempt(6),
+    retry=tenacity.retry_if_exception(_is_transient),
+    before_sleep=_log_retry,
+    reraise=True)
+
+
+class CachedFrontend:
+    '''
+    Wrap a frontend so that every oneshot query is checkpointed to an on-disk
+    cache, keyed by sha256(model|prompt). The map and reduce prompts embed
+    the user question and the chunk text, so an interrupted mapreduce job
+    resumes from the last answered chunk when it is run again.
+
+    Every answer is also appended to a JSONL file next to the cache for
+    easy inspection.
+    '''
+
+    def __init__(self, frtnd: frontend.AbstractFrontend, path: str) -> None:
+        self.frtnd = frtnd
+        self.cache = Cache(path)
+        self.jsonl = os.path.splitext(path)[0] + '.jsonl'
+        self.model = getattr(frtnd, 'model', frtnd.NAME)
+
+    def __getattr__(self, name: str):
+        return getattr(self.frtnd, name)
+
+    def _key(self, message: str) -> str:
+        return hashlib.sha256(f'{self.model}|{message}'.encode()).hexdigest()
+
+    def _store(self, key: str, answer: str) -> None:
+        self.cache[key] = answer
+        with open(self.jsonl, 'a') as f:
+            f.write(json.dumps({'key': key, 'answer': answer}) + '\n')
+
+    def oneshot(self, message: str) -> str:
+        key = self._key(message)
+        if (answer := self.cache.get(key)) is not None:
+            return answer
+        answer = self.frtnd.oneshot(message)
+        self._store(key, answer)
+        return answer
+
+    async def aoneshot(self, message: str) -> str:
+        key = self._key(message)
+        if (answer := self.cache.get(key)) is not None:
+            return answer
+        answer = await self.frtnd.aoneshot(message)
+        self._store(key, answer)
+        return answer
+
+
+class MemoFrontend:
+    '''
+    Wrap a frontend so that the answers already known for some prompts,
+    e.g., those of the probe requests of auto_parallelism(...), are
+    returned once instead of asking the LLM again.
+    '''
+
+    def __init__(self, frtnd: frontend.AbstractFrontend,
+                 memo: Dict[str, str]) -> None:
+        self.frtnd = frtnd
+        self.memo = memo
+
+    def __getattr__(self, name: str):
+        return getattr(self.frtnd, name)
+
+    def oneshot(self, message: str) -> str:
+        if message in self.memo:
+            return self.memo.pop(message)
+        return self.frtnd.oneshot(message)
+
+    async def aoneshot(self, message: str) -> str:
+        if message in self.memo:
+            return self.memo.pop(message)
+        return await self.frtnd.aoneshot(message)
+
+
+def default_parallelism() -> int:
+    '''
+    the parallelism cap of the auto mode. LLM requests are I/O bound, so
+    this follows the default of concurrent.futures.ThreadPoolExecutor, over
+    the CPUs this process may run on.
+    '''
+    try:
+        ncpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        ncpus = os.cpu_count() or 1
+    return min(32, ncpus + 4)
+
+
+@retry_transient
+def probe_oneshot(prompt: str, frtnd: frontend.AbstractFrontend) -> str:
+    '''
+    ask one probe prompt of auto_parallelism(...)
+    '''
+    return frtnd.oneshot(prompt)
+
+
+def auto_parallelism(
+        prompts: List[str],
+        frtnd: frontend.AbstractFrontend,
+        rpm: int,
+        clock: Callable[[], float] = time.monotonic
+) -> Tuple[int, Dict[str, str]]:
+    '''
+    Pick the parallelism from the Requests Per Minute limit and the latency
+    measured on a few prompts asked serially. By Little's law, rpm / 60 *
+    latency requests in flight saturate the limit. We aim at twice that to
+    cover the latency variance, and let the RateLimiter pace the rest.
+
+    Returns:
+        the parallelism, and the answers to the probe prompts
+    '''
+    cap = default_parallelism()
+    if rpm <= 0 or not prompts:
+        return cap, {}
+    answers = {}
+    start = clock()
+    for prompt in prompts:
+        answers[prompt] = probe_oneshot(prompt, frtnd)
+    latency = (clock() - start) / len(prompts)
+    return min(cap, max(1, int(rpm / 60 * latency * 2))), answers
+
+
 def shorten(s: str, maxlen: int = 100) -> str:
     '''
     Shorten the string to a maximum length. Different from default textwrap
     behavior, we will shorten from the other side of the string.
     '''
-    return textwrap.shorten(s, width=maxlen)
+    if len(s) <= maxlen:
+        return s
+    return '......' + s[-(maxlen - 6):]
+
+
+def drop_blank_chunks(chunks: List[Entry]) -> List[Entry]:
+    '''
+    drop the chunks with nothing but whitespace, e.g., from long runs of
+    blank lines. The LLM can only answer nothing for them. The first chunk
+    is kept if all of them are blank.
+    '''
+    return [
+        chunk for chunk in chunks
+        if chunk.content and not chunk.content.isspace()
+    ] or chunks[:1]
+
+
+def dedup_chunks(chunks: List[Entry]) -> List[Entry]:
+    '''
+    drop the chunks whose content is byte-identical to an earlier chunk of
+    the same file, e.g., repeated blocks of a build log. Identical chunks of
+    different files, such as license headers, are all kept, because the
+    answers may have to tell the files apart.
+    '''
+    seen = set()
+    unique = []
+    for chunk in chunks:
+        key = (chunk.path,
+               hashlib.blake2b(chunk.content.encode(),
+                               digest_size=16).digest())
+        if key not in seen:
+            seen.add(key)
+            unique.append(chunk)
+    return unique
+
+
+@ft.lru_cache(maxsize=128)
+def _map_prefix(question: str, plural: bool = False) -> str:
+    '''
+    the instruction header of map prompts. It only depends on the question,
+    so it is built once and shared by all the chunks.
+    '''
+    part = 'parts' if plural else 'part'
+    return ('Extract any information that is relevant to question '
+            f'{repr(question)} from the following file {part}. '
+            'Note, if there is no relevant information, just briefly say nothing.'
+            '\n\n\n')
+
+
+@ft.lru_cache(maxsize=128)
+def _reduce_prefix(question: str) -> str:
+    '''
+    the instruction header of reduce prompts.
+    '''
+    return ('Extract any information that is relevant to question '
+            f'{repr(question)} from the following contents and aggregate them. '
+            'Note, if there is no relevant information, just briefly say nothing.'
+            '\n\n\n')
 
 
 def pad_chunk_before_map(chunk: Entry, question: str) -> str:
     '''
     process a chunk of text with a question
     '''
-    template = 'Extract any information that is relevant to question '
-    template += f'{repr(question)} from the following file part. '
-    template += 'Note, if there is no relevant information, just briefly say nothing.'
-    template += '\n\n\n'
-    template += chunk.wrapfun_chunk(chunk.content)
-    return template
+    return _map_prefix(question) + chunk.wrapfun_chunk(chunk.content)
 
 
 def group_chunks_by_length(chunks: List[Entry],
@@ -95,16 +442,14 @@ def pad_chunks_before_map(chunks: List[Entry], question: str) -> str:
     '''
     process a list of chunks of text with a question
     '''
-    template = 'Extract any information that is relevant to question '
-    template += f'{repr(question)} from the following file parts. '
-    template += 'Note, if there is no relevant information, just briefly say nothing.'
-    template += '\n\n\n'
+    parts = [_map_prefix(question, plural=True)]
     for chunk in chunks:
-        template += chunk.wrapfun_chunk(chunk.content)
-        template += '\n\n'  # add some separation between chunks
-    return template
+        parts.append(chunk.wrapfun_chunk(chunk.content))
+        parts.append('\n\n')  # add some separation between chunks
+    return ''.join(parts)
 
 
+@retry_transient
 def map_chunk(chunk: Entry,
               question: str,
               frtnd: frontend.AbstractFrontend,
@@ -119,11 +464,32 @@ def map_chunk(chunk: Entry,
             shorten(padded_input, _VERBOSE_WRAP_LENGTH))
     answer = frtnd.oneshot(padded_input)
     if verbose:
-        console.print('f[white on red]map:<-({len(answer)})[/white on red]',
+        console.print(f'[white on red]map:<-({len(answer)})[/white on red]',
                       shorten(answer, _VERBOSE_WRAP_LENGTH))
     return answer
 
 
+@retry_transient
+async def amap_chunk(chunk: Entry,
+                     question: str,
+                     frtnd: frontend.AbstractFrontend,
+                     verbose: bool = False) -> str:
+    '''
+    process a chunk of text with a question, asynchronously
+    '''
+    padded_input = pad_chunk_before_map(chunk, question)
+    if verbose:
+        console.print(
+            f'[white on blue]map:({len(padded_input)})->[/white on blue]',
+            shorten(padded_input, _VERBOSE_WRAP_LENGTH))
+    answer = await frtnd.aoneshot(padded_input)
+    if verbose:
+        console.print(f'[white on red]map:<-({len(answer)})[/white on red]',
+                      shorten(answer, _VERBOSE_WRAP_LENGTH))
+    return answer
+
+
+@retry_transient
 def map_chunks(chunks: List[Entry],
                question: str,
                frtnd: frontend.AbstractFrontend,
@@ -145,6 +511,137 @@ def map_chunks(chunks: List[Entry],
     return answer
 
 
+@retry_transient
+async def amap_chunks(chunks: List[Entry],
+                      question: str,
+                      frtnd: frontend.AbstractFrontend,
+                      verbose: bool = False) -> str:
+    '''
+    process a list of chunks of text with a question, asynchronously
+    '''
+    padded_input = pad_chunks_before_map(chunks, question)
+    if verbose:
+        console.print(
+            f'[white on blue]map:({len(padded_input)})->[/white on blue]',
+            shorten(padded_input, _VERBOSE_WRAP_LENGTH))
+    answer = await frtnd.aoneshot(padded_input)
+    if verbose:
+        console.print(f'[white on red]map:<-({len(answer)})[/white on red]',
+                      shorten(answer, _VERBOSE_WRAP_LENGTH))
+    return answer
+
+
+async def gather_bounded(aws: Iterable[Awaitable],
+                         parallelism: int,
+                         description: str,
+                         total: Optional[int] = None) -> List:
+    '''
+    Await the given LLM requests with at most `parallelism` of them in flight
+    at the same time. The awaitables are pulled lazily by `parallelism`
+    workers, so when a generator is given, only the prompts being processed
+    are alive. The results keep the input order.
+    '''
+    results: Dict[int, object] = {}
+    pending = enumerate(aws)
+    with Progress(transient=True) as progress:
+        task = progress.add_task(description, total=total)
+
+        async def _worker() -> None:
+            for idx, aw in pending:
+                results[idx] = await aw
+                progress.advance(task)
+
+        await asyncio.gather(*[_worker() for _ in range(parallelism)])
+    return [results[idx] for idx in range(len(results))]
+
+
+_BATCH_ANSWER_RE = re.compile(r'^=== ANSWER (\d+) ===[ \t]*$', re.M)
+
+
+def pad_chunk_batch_before_map(chunks: List[Entry], question: str) -> str:
+    '''
+    process a batch of chunks of text with a question, in a single request
+    that asks for one labeled answer per chunk
+    '''
+    parts = [
+        'Extract any information that is relevant to question '
+        f'{repr(question)} from each of the following {len(chunks)} file '
+        'parts separately. Note, if there is no relevant information in a '
+        'part, just briefly say nothing for it. Answer every part i in a '
+        "section starting with a line '=== ANSWER i ===', in order."
+        '\n\n\n'
+    ]
+    for i, chunk in enumerate(chunks):
+        parts.extend((f'=== CHUNK {i} ===\n',
+                      chunk.wrapfun_chunk(chunk.content), '\n\n'))
+    return ''.join(parts)
+
+
+def split_batch_answer(answer: str, n: int) -> List[str]:
+    '''
+    split the answer to a batch prompt into the per-chunk answers. If the
+    answer does not follow the requested layout, keep it as a whole, which
+    is still a valid intermediate result for the reduce phase.
+    '''
+    pieces = _BATCH_ANSWER_RE.split(answer)
+    # pieces: [preamble, '0', answer0, '1', answer1, ...]
+    labels = pieces[1::2]
+    if labels != [str(i) for i in range(n)]:
+        return [answer]
+    return [x.strip() for x in pieces[2::2]]
+
+
+@retry_transient
+def map_chunk_batch(chunks: List[Entry],
+                    question: str,
+                    frtnd: frontend.AbstractFrontend,
+                    verbose: bool = False) -> List[str]:
+    '''
+    process a batch of chunks of text with a question, in one request
+    '''
+    padded_input = pad_chunk_batch_before_map(chunks, question)
+    if verbose:
+        console.print(
+            f'[white on blue]map:({len(padded_input)})->[/white on blue]',
+            shorten(padded_input, _VERBOSE_WRAP_LENGTH))
+    answer = frtnd.oneshot(padded_input)
+    if verbose:
+        console.print(f'[white on red]map:<-({len(answer)})[/white on red]',
+                      shorten(answer, _VERBOSE_WRAP_LENGTH))
+    return split_batch_answer(answer, len(chunks))
+
+
+@retry_transient
+async def amap_chunk_batch(chunks: List[Entry],
+                           question: str,
+                           frtnd: frontend.AbstractFrontend,
+                           verbose: bool = False) -> List[str]:
+    '''
+    process a batch of chunks of text with a question, asynchronously
+    '''
+    padded_input = pad_chunk_batch_before_map(chunks, question)
+    if verbose:
+        console.print(
+            f'[white on blue]map:({len(padded_input)})->[/white on blue]',
+            shorten(padded_input, _VERBOSE_WRAP_LENGTH))
+    answer = await frtnd.aoneshot(padded_input)
+    if verbose:
+        console.print(f'[white on red]map:<-({len(answer)})[/white on red]',
+                      shorten(answer, _VERBOSE_WRAP_LENGTH))
+    return split_batch_answer(answer, len(chunks))
+
+
+def group_chunks_by_count(chunks: List[Entry],
+                          batch_size: int) -> List[List[Entry]]:
+    '''
+    split the chunks into consecutive batches of at most batch_size chunks
+    '''
+    assert batch_size > 0
+    return [
+        chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)
+    ]
+
+
 def map_serial(chunks: List[Entry],
                user_question: str,
                frtnd: frontend.AbstractFrontend,
@@ -180,26 +677,54 @@ def map_serial_compact(chunks: List[Entry],
     return results
 
 
-def map_parallel(chunks: List[Entry],
+async def amap_parallel(chunks: Iterable[Entry],
+                        user_question: str,
+                        frtnd: frontend.AbstractFrontend,
+                        verbose: bool = False,
+                        parallelism: int = 2) -> List[str]:
+    '''
+    This is the first pass of mapreduce. We map each chunk to LLM and get the
+    result. This is a parallel implementation, where the requests are issued
+    concurrently from an event loop. The chunks may be given as a generator,
+    in which case they are consumed lazily.
+    '''
+    total = len(chunks) if hasattr(chunks, '__len__') else None
+    aws = (amap_chunk(c, user_question, frtnd, verbose) for c in chunks)
+    return await gather_bounded(aws, parallelism,
+                                f'MapReduce[{parallelism}]:', total)
+
+
+def map_parallel(chunks: Iterable[Entry],
                  user_question: str,
                  frtnd: frontend.AbstractFrontend,
                  verbose: bool = False,
                  parallelism: int = 2) -> List[str]:
     '''
+    the synchronous entry of amap_parallel(...)
+    '''
+    return _clients.run(
+        amap_parallel(chunks, user_question, frtnd, verbose, parallelism))
+
+
+async def amap_parallel_compact(chunks: List[Entry],
+                                user_question: str,
+                                frtnd: frontend.AbstractFrontend,
+                                verbose: bool = False,
+                                parallelism: int = 2,
+                                max_chunk_size: int = -1) -> List[str]:
+    '''
     This is the first pass of mapreduce. We map each chunk to LLM and get the
-    result. This is a parallel implementation.
-    '''
-    worker = ft.partial(map_chunk,
-                        question=user_question,
-                        frtnd=frtnd,
-                        verbose=verbose)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as ex:
-        results = list(
-            track(ex.map(worker, chunks),
-                  total=len(chunks),
-                  description=f'MapReduce[{parallelism}]:',
-                  transient=True))
-    return results
+    result. This is a parallel implementation, and we use compact mode.
+    '''
+    grouped_chunks = group_chunks_by_length(chunks, max_chunk_size)
+    console.print(
+        f'[bold]MapReduce[/bold]: mapping {len(chunks)} chunks ({len(grouped_chunks)} groups)'
+    )
+    aws = (amap_chunks(pack, user_question, frtnd, verbose)
+           for pack in grouped_chunks)
+    return await gather_bounded(aws, parallelism,
+                                f'MapReduce[{parallelism}]:',
+                                len(grouped_chunks))
 
 
 def map_parallel_compact(chunks: List[Entry],
@@ -209,36 +734,76 @@ def map_parallel_compact(chunks: List[Entry],
                          parallelism: int = 2,
                          max_chunk_size: int = -1) -> List[str]:
     '''
-    This is the first pass of mapreduce. We map each chunk to LLM and get the
-    result. This is a parallel implementation, and we use compact mode.
+    the synchronous entry of amap_parallel_compact(...)
     '''
-    worker = ft.partial(map_chunks,
-                        question=user_question,
-                        frtnd=frtnd,
-                        verbose=verbose)
-    grouped_chunks = group_chunks_by_length(chunks, max_chunk_size)
+    return _clients.run(
+        amap_parallel_compact(chunks, user_question, frtnd, verbose,
+                              parallelism, max_chunk_size))
+
+
+def map_serial_batch(chunks: List[Entry],
+                     user_question: str,
+                     frtnd: frontend.AbstractFrontend,
+                     verbose: bool = False,
+                     batch_size: int = 4) -> List[str]:
+    '''
+    This is the first pass of mapreduce. We map each batch of chunks to LLM
+    in one request and get one result per chunk. This is a serial
+    implementation, and we use batch mode.
+    '''
+    batches = group_chunks_by_count(chunks, batch_size)
     console.print(
-        f'[bold]MapReduce[/bold]: mapping {len(chunks)} chunks ({len(grouped_chunks)} groups)'
+        f'[bold]MapReduce[/bold]: mapping {len(chunks)} chunks ({len(batches)} batches)'
     )
-    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as ex:
-        results = list(
-            track(ex.map(worker, grouped_chunks),
-                  total=len(grouped_chunks),
-                  description=f'MapReduce[{parallelism}]:',
-                  transient=True))
+    results = []
+    for batch in track(batches, total=len(batches), description='MapReduce:'):
+        results.extend(
+            map_chunk_batch(batch, user_question, frtnd, verbose=verbose))
     return results
 
 
+async def amap_parallel_batch(chunks: List[Entry],
+                              user_question: str,
+                              frtnd: frontend.AbstractFrontend,
+                              verbose: bool = False,
+                              parallelism: int = 2,
+                              batch_size: int = 4) -> List[str]:
+    '''
+    This is the first pass of mapreduce. We map each batch of chunks to LLM
+    in one request and get one result per chunk. This is a parallel
+    implementation, and we use batch mode.
+    '''
+    batches = group_chunks_by_count(chunks, batch_size)
+    console.print(
+        f'[bold]MapReduce[/bold]: mapping {len(chunks)} chunks ({len(batches)} batches)'
+    )
+    aws = (amap_chunk_batch(batch, user_question, frtnd, verbose)
+           for batch in batches)
+    results = await gather_bounded(aws, parallelism,
+                                   f'MapReduce[{parallelism}]:', len(batches))
+    return [r for batch_results in results for r in batch_results]
+
+
+def map_parallel_batch(chunks: List[Entry],
+                       user_question: str,
+                       frtnd: frontend.AbstractFrontend,
+                       verbose: bool = False,
+                       parallelism: int = 2,
+                       batch_size: int = 4) -> List[str]:
+    '''
+    the synchronous entry of amap_parallel_batch(...)
+    '''
+    return _clients.run(
+        amap_parallel_batch(chunks, user_question, frtnd, verbose, parallelism,
+                            batch_size))
+
+
 def pad_two_results_for_reduce(a: str, b: str, question: str) -> str:
-    template = 'Extract any information that is relevant to question '
-    template += f'{repr(question)} from the following contents and aggregate them. '
-    template += 'Note, if there is no relevant information, just briefly say nothing.'
-    template += '\n\n\n'
-    template += '```\n' + a + '\n```\n\n'
-    template += '```\n' + b + '\n```\n\n'
-    return template
+    return ''.join((_reduce_prefix(question), '```\n', a, '\n```\n\n```\n', b,
+                    '\n```\n\n'))
 
 
+@retry_transient
 def reduce_two_chunks(a: str,
                       b: str,
                       question: str,
@@ -250,23 +815,51 @@ def reduce_two_chunks(a: str,
             f'[white on blue]reduce:({len(padded_input)})->[/white on blue]',
             shorten(padded_input, _VERBOSE_WRAP_LENGTH))
     answer = frtnd.oneshot(padded_input)
+    if verbose:
+        console.print(f'[white on red]reduce:<-({len(answer)})[/white on red]',
+                      shorten(answer, _VERBOSE_WRAP_LENGTH))
+    return answer
+
+
+@retry_transient
+async def areduce_two_chunks(a: str,
+                             b: str,
+                             question: str,
+                             frtnd: frontend.AbstractFrontend,
+                             verbose: bool = False) -> str:
+    padded_input = pad_two_results_for_reduce(a, b, question)
     if verbose:
         console.print(
-            f'[white on red]reduce:<-({len(padded_input)})[/white on red]',
-            shorten(answer, _VERBOSE_WRAP_LENGTH))
+            f'[white on blue]reduce:({len(padded_input)})->[/white on blue]',
+            shorten(padded_input, _VERBOSE_WRAP_LENGTH))
+    answer = await frtnd.aoneshot(padded_input)
+    if verbose:
+        console.print(f'[white on red]reduce:<-({len(answer)})[/white on red]',
+                      shorten(answer, _VERBOSE_WRAP_LENGTH))
     return answer
 
 
 def pad_many_results_for_reduce(results: List[str], question: str) -> str:
-    template = 'Extract any information that is relevant to question '
-    template += f'{repr(question)} from the following contents and aggregate them. '
-    template += 'Note, if there is no relevant information, just briefly say nothing.'
-    template += '\n\n\n'
+    parts = [_reduce_prefix(question)]
     for r in results:
-        template += '```\n' + r + '\n```\n\n'
-    return template
+        parts.extend(('```\n', r, '\n```\n\n'))
+    return ''.join(parts)
 
 
+def fits_in_context(results: List[str], question: str,
+                    context_budget: int) -> bool:
+    '''
+    whether all the results fit into a single reduce request shorter than
+    context_budget bytes, see pad_many_results_for_reduce(...). A
+    non-positive budget never fits.
+    '''
+    if context_budget <= 0:
+        return False
+    overhead = len(_reduce_prefix(question)) + 10 * len(results)
+    return overhead + sum(map(len, results)) < context_budget
+
+
+@retry_transient
 def reduce_many_chunks(results: List[str],
                        question: str,
                        frtnd: frontend.AbstractFrontend,
@@ -277,13 +870,114 @@ def reduce_many_chunks(results: List[str],
             f'[white on blue]reduce:({len(padded_input)})->[/white on blue]',
             shorten(padded_input, _VERBOSE_WRAP_LENGTH))
     answer = frtnd.oneshot(padded_input)
+    if verbose:
+        console.print(f'[white on red]reduce:<-({len(answer)})[/white on red]',
+                      shorten(answer, _VERBOSE_WRAP_LENGTH))
+    return answer
+
+
+@retry_transient
+async def areduce_many_chunks(results: List[str],
+                              question: str,
+                              frtnd: frontend.AbstractFrontend,
+                              verbose: bool = False) -> str:
+    padded_input = pad_many_results_for_reduce(results, question)
     if verbose:
         console.print(
-            f'[white on red]reduce:<-({len(padded_input)})[/white on red]',
-            shorten(answer, _VERBOSE_WRAP_LENGTH))
+            f'[white on blue]reduce:({len(padded_input)})->[/white on blue]',
+            shorten(padded_input, _VERBOSE_WRAP_LENGTH))
+    answer = await frtnd.aoneshot(padded_input)
+    if verbose:
+        console.print(f'[white on red]reduce:<-({len(answer)})[/white on red]',
+                      shorten(answer, _VERBOSE_WRAP_LENGTH))
     return answer
 
 
+def reduce_group(results: List[str],
+                 question: str,
+                 frtnd: frontend.AbstractFrontend,
+                 verbose: bool = False) -> str:
+    '''
+    reduce a group of results in one request. A single result is passed
+    through as is.
+    '''
+    if len(results) == 1:
+        return results[0]
+    return reduce_many_chunks(results, question, frtnd, verbose)
+
+
+async def areduce_group(results: List[str],
+                        question: str,
+                        frtnd: frontend.AbstractFrontend,
+                        verbose: bool = False) -> str:
+    '''
+    the asynchronous version of reduce_group(...)
+    '''
+    if len(results) == 1:
+        return results[0]
+    return await areduce_many_chunks(results, question, frtnd, verbose)
+
+
+@ft.lru_cache(maxsize=128)
+def _rolling_prefix(question: str) -> str:
+    '''
+    the instruction header of rolling reduce prompts.
+    '''
+    return ('Extract any information that is relevant to question '
+            f'{repr(question)} from the following file part, and aggregate it '
+            'with the existing notes enclosed in the code block. '
+            'Note, if there is no relevant information, just briefly repeat '
+            'the existing notes.'
+            '\n\n\n')
+
+
+def pad_chunk_for_rolling(acc: str, chunk: Entry, question: str) -> str:
+    '''
+    fold a new chunk of text into the running answer
+    '''
+    return ''.join((_rolling_prefix(question), '```\n', acc, '\n```\n\n',
+                    chunk.wrapfun_chunk(chunk.content)))
+
+
+@retry_transient
+def fold_chunk(acc: str,
+               chunk: Entry,
+               question: str,
+               frtnd: frontend.AbstractFrontend,
+               verbose: bool = False) -> str:
+    '''
+    fold a chunk of text into the running answer
+    '''
+    padded_input = pad_chunk_for_rolling(acc, chunk, question)
+    if verbose:
+        console.print(
+            f'[white on blue]reduce:({len(padded_input)})->[/white on blue]',
+            shorten(padded_input, _VERBOSE_WRAP_LENGTH))
+    answer = frtnd.oneshot(padded_input)
+    if verbose:
+        console.print(f'[white on red]reduce:<-({len(answer)})[/white on red]',
+                      shorten(answer, _VERBOSE_WRAP_LENGTH))
+    return answer
+
+
+def mapreduce_rolling(chunks: List[Entry],
+                      question: str,
+                      frtnd: frontend.AbstractFrontend,
+                      verbose: bool = False) -> str:
+    '''
+    Fused map and reduce. Keep one running answer, and fold every new chunk
+    into it. This takes N LLM calls for N chunks, while binary map and
+    reduce take 2N-1 calls. The prompt size is bounded by the chunk size
+    plus the size of the running answer. It is inherently serial.
+    '''
+    acc = map_chunk(chunks[0], question, frtnd, verbose=verbose)
+    for chunk in track(chunks[1:],
+                       total=len(chunks) - 1,
+                       description='MapReduce:'):
+        acc = fold_chunk(acc, chunk, question, frtnd, verbose=verbose)
+    return acc
+
+
 def group_strings_by_length(strings: List[str],
                             max_length: int) -> List[List[str]]:
     '''
@@ -329,24 +1023,30 @@ def group_strings_by_length(strings: List[str],
 def reduce_serial(results: List[str],
                   question: str,
                   frtnd: frontend.AbstractFrontend,
-                  verbose: bool = False) -> str:
+                  verbose: bool = False,
+                  context_budget: int = 0,
+                  fanout: int = 2) -> str:
     '''
     recursive reduction of multiple results, until only one result is left.
-    We do this binary reduction in serial mode.
+    We do this binary reduction in serial mode, or reduce up to fanout results
+    per request when fanout is larger than 2. Once the remaining results
+    fit in context_budget, they are reduced at once in a single request.
     '''
+    assert fanout >= 2
     while len(results) > 1:
+        if fits_in_context(results, question, context_budget):
+            console.print(
+                f'[bold]MapReduce[/bold]: reducing {len(results)} intermediate results at once'
+            )
+            return reduce_many_chunks(results, question, frtnd, verbose)
         console.print(
             f'[bold]MapReduce[/bold]: reducing {len(results)} intermediate results'
         )
-        new_results = []
-        for (a, b) in track(zip(results[::2], results[1::2]),
-                            total=len(results) // 2,
-                            description='Mapreduce:'):
-            new_results.append(
-                reduce_two_chunks(a, b, question, frtnd, verbose))
-        if len(results) % 2 == 1:
-            new_results.append(results[-1])
-        results = new_results
+        groups = group_chunks_by_count(results, fanout)
+        results = [
+            reduce_group(pack, question, frtnd, verbose) for pack in track(
+                groups, total=len(groups), description='Mapreduce:')
+        ]
     return results[0]
 
 
@@ -372,33 +1072,74 @@ def reduce_serial_compact(results: List[str],
     return results[0]
 
 
+async def areduce_parallel(results: List[str],
+                           question: str,
+                           frtnd: frontend.AbstractFrontend,
+                           verbose: bool = False,
+                           parallelism: int = 2,
+                           context_budget: int = 0,
+                           fanout: int = 2) -> str:
+    '''
+    recursive reduction of multiple results, until only one result is left.
+    All groups of up to fanout results of the same level are reduced
+    concurrently. Once the remaining results fit in context_budget, they are
+    reduced at once in a single request.
+    '''
+    assert fanout >= 2
+    while len(results) > 1:
+        if fits_in_context(results, question, context_budget):
+            console.print(
+                f'[bold]MapReduce[/bold]: reducing {len(results)} intermediate results at once'
+            )
+            return await areduce_many_chunks(results, question, frtnd,
+                                             verbose)
+        groups = group_chunks_by_count(results, fanout)
+        console.print(
+            f'[bold]MapReduce[/bold]: reducing {len(results)} intermediate results ({len(groups)} groups)'
+        )
+        aws = (areduce_group(pack, question, frtnd, verbose)
+               for pack in groups)
+        results = await gather_bounded(aws, parallelism,
+                                       f'Mapreduce[{parallelism}]:',
+                                       len(groups))
+    return results[0]
+
+
 def reduce_parallel(results: List[str],
                     question: str,
                     frtnd: frontend.AbstractFrontend,
                     verbose: bool = False,
-                    parallelism: int = 2) -> str:
+                    parallelism: int = 2,
+                    context_budget: int = 0,
+                    fanout: int = 2) -> str:
     '''
-    recursive reduction of multiple results, until only one result is left
+    the synchronous entry of areduce_parallel(...)
+    '''
+    return _clients.run(
+        areduce_parallel(results, question, frtnd, verbose, parallelism,
+                         context_budget, fanout))
+
+
+async def areduce_parallel_compact(results: List[str],
+                                   question: str,
+                                   frtnd: frontend.AbstractFrontend,
+                                   verbose: bool = False,
+                                   parallelism: int = 2,
+                                   max_chunk_size: int = -1) -> str:
+    '''
+    recursive reduction of multiple results, until only one result is left.
+    All groups of the same level are reduced concurrently.
     '''
-    worker = ft.partial(reduce_two_chunks,
-                        question=question,
-                        frtnd=frtnd,
-                        verbose=verbose)
     while len(results) > 1:
-        pairs = list(zip(results[::2], results[1::2]))
+        groups = group_strings_by_length(results, max_chunk_size)
         console.print(
-            f'[bold]MapReduce[/bold]: reducing {len(results)} intermediate results ({len(pairs)} pairs)'
+            f'[bold]MapReduce[/bold]: reducing {len(results)} intermediate results ({len(groups)} groups)'
         )
-        with concurrent.futures.ThreadPoolExecutor(
-                max_workers=parallelism) as ex:
-            new_results = list(
-                track(ex.map(lambda x: worker(*x), pairs),
-                      total=len(pairs),
-                      description=f'Mapreduce[{parallelism}]:',
-                      transient=True))
-        if len(results) % 2 == 1:
-            new_results.append(results[-1])
-        results = new_results
+        aws = (areduce_many_chunks(pack, question, frtnd, verbose)
+               for pack in groups)
+        results = await gather_bounded(aws, parallelism,
+                                       f'Mapreduce[{parallelism}]:',
+                                       len(groups))
     return results[0]
 
 
@@ -409,26 +1150,242 @@ def reduce_parallel_compact(results: List[str],
                             parallelism: int = 2,
                             max_chunk_size: int = -1) -> str:
     '''
-    recursive reduction of multiple results, until only one result is left
+    the synchronous entry of areduce_parallel_compact(...)
     '''
-    worker = ft.partial(reduce_many_chunks,
-                        question=question,
-                        frtnd=frtnd,
-                        verbose=verbose)
-    while len(results) > 1:
-        groups = group_strings_by_length(results, max_chunk_size)
-        console.print(
-            f'[bold]MapReduce[/bold]: reducing {len(results)} intermediate results ({len(groups)} groups)'
-        )
-        with concurrent.futures.ThreadPoolExecutor(
-                max_workers=parallelism) as ex:
-            new_results = list(
-                track(ex.map(worker, groups),
-                      total=len(groups),
-                      description=f'Mapreduce[{parallelism}]:',
-                      transient=True))
-        results = new_results
-    return results[0]
+    return _clients.run(
+        areduce_parallel_compact(results, question, frtnd, verbose,
+                                 parallelism, max_chunk_size))
+
+
+async def amapreduce_pipelined(chunks: List[Entry],
+                               question: str,
+                               frtnd: frontend.AbstractFrontend,
+                               verbose: bool = False,
+                               parallelism: int = 2,
+                               compact_map_mode: bool = False,
+                               max_chunk_size: int = -1) -> str:
+    '''
+    Parallel map and binary reduce, as a dataflow graph instead of
+    level-by-level barriers. A reduction is issued as soon as both of its
+    inputs are ready, so the reduce tree overlaps with the chunks that are
+    still being mapped. At most `parallelism` LLM requests, map or reduce,
+    are in flight at the same time. In compact map mode, the leaves of the
+    tree are groups of chunks instead of single chunks.
+
+    The chunk list is emptied once grouped into leaves, and every leaf is
+    dropped as soon as it is mapped, so that the chunk texts do not stay in
+    memory for the rest of the reduce tree.
+    '''
+    nchunks = len(chunks)
+    if compact_map_mode:
+        leaves = group_chunks_by_length(chunks, max_chunk_size)
+    else:
+        leaves = [[chunk] for chunk in chunks]
+    chunks.clear()
+    semaphore = asyncio.Semaphore(parallelism)
+
+    def _map(leaf: List[Entry]) -> Awaitable[str]:
+        if compact_map_mode:
+            return amap_chunks(leaf, question, frtnd, verbose)
+        return amap_chunk(leaf[0], question, frtnd, verbose)
+
+    nrequests = 2 * len(leaves) - 1
+    console.print(
+        f'[bold]MapReduce[/bold]: pipelining {nchunks} chunks ({len(leaves)} groups) through {nrequests} requests'
+    )
+    with Progress(transient=True) as progress:
+        task = progress.add_task(f'MapReduce[{parallelism}]:',
+                                 total=nrequests)
+
+        async def _bounded(aw: Awaitable[str]) -> str:
+            async with semaphore:
+                result = await aw
+            progress.advance(task)
+            return result
+
+        async def _node(lo: int, hi: int) -> str:
+            if hi - lo == 1:
+                leaf, leaves[lo] = leaves[lo], None
+                return await _bounded(_map(leaf))
+            mid = (lo + hi) // 2
+            a, b = await asyncio.gather(_node(lo, mid), _node(mid, hi))
+            return await _bounded(
+                areduce_two_chunks(a, b, question, frtnd, verbose))
+
+        return await _node(0, len(leaves))
+
+
+def mapreduce_pipelined(chunks: List[Entry],
+                        question: str,
+                        frtnd: frontend.AbstractFrontend,
+                        verbose: bool = False,
+                        parallelism: int = 2,
+                        compact_map_mode: bool = False,
+                        max_chunk_size: int = -1) -> str:
+    '''
+    the synchronous entry of amapreduce_pipelined(...)
+    '''
+    return _clients.run(
+        amapreduce_pipelined(chunks, question, frtnd, verbose, parallelism,
+                             compact_map_mode, max_chunk_size))
+
+
+async def amapreduce_streamed(chunks: List[Entry],
+                              question: str,
+                              frtnd: frontend.AbstractFrontend,
+                              verbose: bool = False,
+                              compact_map_mode: bool = False,
+                              max_chunk_size: int = -1) -> str:
+    '''
+    Serial map phase, with a linear fold reduce running alongside it. The
+    answer of each leaf is reduced into the accumulated answer while the
+    next leaf is being mapped, so that at most one map and one reduce
+    request are in flight. Like the binary tree, this takes N map and N-1
+    reduce requests. In compact map mode, the leaves are groups of chunks.
+    Like amapreduce_pipelined(...), the chunk list is emptied and every leaf
+    is dropped once mapped.
+    '''
+    nchunks = len(chunks)
+    if compact_map_mode:
+        leaves = group_chunks_by_length(chunks, max_chunk_size)
+    else:
+        leaves = [[chunk] for chunk in chunks]
+    chunks.clear()
+    nleaves = len(leaves)
+    answers: asyncio.Queue = asyncio.Queue()
+
+    async def _produce() -> None:
+        # consume the leaves in order
+        leaves.reverse()
+        while leaves:
+            leaf = leaves.pop()
+            if compact_map_mode:
+                answer = await amap_chunks(leaf, question, frtnd, verbose)
+            else:
+                answer = await amap_chunk(leaf[0], question, frtnd, verbose)
+            await answers.put(answer)
+            progress.advance(task)
+
+    nrequests = 2 * nleaves - 1
+    console.print(
+        f'[bold]MapReduce[/bold]: streaming {nchunks} chunks ({nleaves} groups) through {nrequests} requests'
+    )
+    async def _next_answer() -> str:
+        # wait on the producer as well, which would never put the answer
+        # once a map request has failed
+        getter = asyncio.ensure_future(answers.get())
+        done, _ = await asyncio.wait({getter, producer},
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if getter not in done and producer.exception() is not None:
+            getter.cancel()
+            producer.result()
+        return await getter
+
+    with Progress(transient=True) as progress:
+        task = progress.add_task('MapReduce:', total=nrequests)
+        producer = asyncio.create_task(_produce())
+        try:
+            acc = await _next_answer()
+            for _ in range(nleaves - 1):
+                acc = await areduce_two_chunks(acc, await _next_answer(),
+                                               question, frtnd, verbose)
+                progress.advance(task)
+            await producer
+        finally:
+            # a failed reduce request must not leave the map phase running
+            producer.cancel()
+    return acc
+
+
+def mapreduce_streamed(chunks: List[Entry],
+                       question: str,
+                       frtnd: frontend.AbstractFrontend,
+                       verbose: bool = False,
+                       compact_map_mode: bool = False,
+                       max_chunk_size: int = -1) -> str:
+    '''
+    the synchronous entry of amapreduce_streamed(...)
+    '''
+    return _clients.run(
+        amapreduce_streamed(chunks, question, frtnd, verbose,
+                            compact_map_mode, max_chunk_size))
+
+
+async def amapreduce_parallel(chunks: List[Entry],
+                              question: str,
+                              frtnd: frontend.AbstractFrontend,
+                              verbose: bool = False,
+                              parallelism: int = 2,
+                              compact_map_mode: bool = True,
+                              compact_reduce_mode: bool = True,
+                              max_chunk_size: int = -1,
+                              map_batch_size: int = 1,
+                              context_budget: int = 0,
+                              reduce_fanout: int = 2) -> str:
+    '''
+    The parallel map and reduce phases. They run in one event loop, so that
+    the worker threads of the blocking frontends and the connection pool of
+    the async clients are shared by the map phase and all reduce levels.
+    The chunk list is emptied after the map phase, to release the texts.
+    '''
+    # the blocking frontends run in the default executor of the loop. Size it
+    # to the parallelism, instead of the min(32, cpus + 4) threads by default.
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=parallelism))
+
+    # overlapped map and binary reduce phases. The size-aware and the k-way
+    # reduces need all the intermediate results, hence the map phase barrier.
+    if (not compact_reduce_mode and context_budget <= 0
+            and reduce_fanout == 2
+            and (compact_map_mode or map_batch_size == 1)):
+        return await amapreduce_pipelined(chunks,
+                                          question,
+                                          frtnd,
+                                          verbose=verbose,
+                                          parallelism=parallelism,
+                                          compact_map_mode=compact_map_mode,
+                                          max_chunk_size=max_chunk_size)
+
+    # map phase
+    if compact_map_mode:
+        intermediate_results = await amap_parallel_compact(
+            chunks,
+            question,
+            frtnd,
+            verbose=verbose,
+            parallelism=parallelism,
+            max_chunk_size=max_chunk_size)
+    elif map_batch_size > 1:
+        intermediate_results = await amap_parallel_batch(
+            chunks,
+            question,
+            frtnd,
+            verbose=verbose,
+            parallelism=parallelism,
+            batch_size=map_batch_size)
+    else:
+        intermediate_results = await amap_parallel(chunks,
+                                                   question,
+                                                   frtnd,
+                                                   verbose=verbose,
+                                                   parallelism=parallelism)
+    chunks.clear()
+
+    # reduce phase
+    if compact_reduce_mode:
+        return await areduce_parallel_compact(intermediate_results,
+                                              question,
+                                              frtnd,
+                                              verbose=verbose,
+                                              parallelism=parallelism,
+                                              max_chunk_size=max_chunk_size)
+    return await areduce_parallel(intermediate_results,
+                                  question,
+                                  frtnd,
+                                  verbose=verbose,
+                                  parallelism=parallelism,
+                                  context_budget=context_budget,
+                                  fanout=reduce_fanout)
 
 
 def mapreduce_super_long_context(
@@ -440,6 +1397,15 @@ def mapreduce_super_long_context(
     compact_map_mode: bool = True,
     compact_reduce_mode: bool = True,
     parallelism: int = 1,
+    cache: Optional[str] = None,
+    rolling_mode: bool = False,
+    token_budget: int = 0,
+    map_batch_size: int = 1,
+    context_budget: int = 0,
+    rpm: int = 0,
+    tpm: int = 0,
+    reduce_fanout: int = 2,
+    dedup: bool = False,
 ) -> str:
     '''
     Divide and conquer any-length-context.
@@ -455,7 +1421,8 @@ def mapreduce_super_long_context(
       4. return the aggregated LLM output
 
     Note, with parallel processing, we may easily exceed the Token Per Minute
-    (TPM) limit set by the service provider. We will automatically retry until
+    (TPM) limit set by the service provider. Set rpm and tpm to pace the
+    requests below the limits, otherwise we automatically retry until
     success.
 
     Args:
@@ -465,7 +1432,29 @@ def mapreduce_super_long_context(
         user_question: the user question
         verbose: verbose mode
         compact_reduce_mode: use compact reduce mode, instead of binary reduction
-        parallelism: the parallelism
+        parallelism: the parallelism. 0 picks it automatically, see
+          auto_parallelism(...).
+        cache: path to the on-disk answer cache. Previously answered map and
+          reduce queries are loaded from it instead of asking the LLM again.
+          Caching is disabled when None.
+        rolling_mode: fold the chunks one by one into a running answer,
+          instead of separate map and reduce phases. This ignores the other
+          modes and the parallelism.
+        token_budget: the maximum number of estimated tokens in flight in the
+          parallel mode, e.g., the TPM limit of the provider. 0 is unlimited.
+        map_batch_size: the number of chunks asked in one map request, each
+          answered separately. Only used when compact_map_mode is False.
+        context_budget: in the binary reduce mode, reduce all the remaining
+          intermediate results in a single request once their total size in
+          bytes fits in this budget. 0 disables it.
+        rpm: the Requests Per Minute limit of the provider. 0 is unlimited.
+        tpm: the estimated Tokens Per Minute limit of the provider. 0 is
+          unlimited.
+        reduce_fanout: in the binary reduce mode, the number of intermediate
+          results reduced per request. Larger fanouts need fewer reduce
+          levels, i.e., ceil(log_fanout(N)) rounds of requests.
+        dedup: skip the chunks identical to an earlier chunk of the same
+          file, see dedup_chunks(...).
     Returns:
         the aggregated result from LLM after mapreduce, as a string
     '''
@@ -485,55 +1474,123 @@ def mapreduce_super_long_context(
             firstline = chunk.wrapfun_chunk('').split('\n')[0].rstrip(':')
             console.print(f'  [bold]Chunk {i}[/bold]: {firstline}...')
 
+    # skip the blank chunks
+    if len(nonblank_chunks := drop_blank_chunks(chunks)) < len(chunks):
+        console.print(
+            f'[bold]MapReduce[/bold]: skipped {len(chunks) - len(nonblank_chunks)} blank chunks')
+        chunks = nonblank_chunks
+
+    # skip the duplicated chunks, if asked to
+    if dedup and len(unique_chunks := dedup_chunks(chunks)) < len(chunks):
+        console.print(
+            f'[bold]MapReduce[/bold]: skipped {len(chunks) - len(unique_chunks)} duplicated chunks')
+        chunks = unique_chunks
+
     # skip mapreduce if there is only one chunk
     if len(chunks) == 1:
         return chunks[0].wrapfun_chunk(chunks[0].content)
     assert len(chunks) > 1  # at least two chunks
 
-    # map phase
-    if parallelism > 1 and compact_map_mode:
-        intermediate_results = map_parallel_compact(
+    # limit the tokens in flight. Cache hits do not count.
+    if token_budget > 0:
+        frtnd = BudgetedFrontend(frtnd, TokenBudgetLimiter(token_budget))
+
+    # pace the requests below the rate limits. Cache hits do not count.
+    if rpm > 0 or tpm > 0:
+        frtnd = RateLimitedFrontend(frtnd, RateLimiter(rpm, tpm))
+
+    # resume from the checkpointed answers, if any
+    if cache is not None:
+        frtnd = CachedFrontend(frtnd, cache)
+
+    # measure the latency on the first map requests, keeping their answers.
+    # Without a rate limit there is nothing to measure.
+    if parallelism <= 0 and not rolling_mode:
+        if rpm <= 0:
+            probes = []
+        elif compact_map_mode:
+            probes = [
+                pad_chunks_before_map(pack, user_question)
+                for pack in itertools.islice(
+                    group_chunks_by_length(chunks, max_chunk_size), 4)
+            ]
+        elif map_batch_size > 1:
+            probes = [
+                pad_chunk_batch_before_map(pack, user_question)
+                for pack in itertools.islice(
+                    group_chunks_by_count(chunks, map_batch_size), 4)
+            ]
+        else:
+            probes = [
+                pad_chunk_before_map(c, user_question) for c in chunks[:4]
+            ]
+        parallelism, answers = auto_parallelism(probes, frtnd, rpm)
+        console.print(
+            f'[bold]MapReduce[/bold]: using parallelism {parallelism}')
+        frtnd = MemoFrontend(frtnd, answers)
+
+    # fused map and reduce phases
+    if rolling_mode:
+        aggregated_result = mapreduce_rolling(chunks,
+                                              user_question,
+                                              frtnd,
+                                              verbose=verbose)
+        return aggregated_result + '\n\n'
+
+    # parallel map and reduce phases, in one event loop
+    if parallelism > 1:
+        aggregated_result = _clients.run(
+            amapreduce_parallel(chunks,
+                                user_question,
+                                frtnd,
+                                verbose=verbose,
+                                parallelism=parallelism,
+                                compact_map_mode=compact_map_mode,
+                                compact_reduce_mode=compact_reduce_mode,
+                                max_chunk_size=max_chunk_size,
+                                map_batch_size=map_batch_size,
+                                context_budget=context_budget,
+                                reduce_fanout=reduce_fanout))
+        return aggregated_result + '\n\n'
+
+    # serial map and a fold reduce alongside it, for the network frontends.
+    # The size-aware and the k-way reduces need all the intermediate results.
+    if (not compact_reduce_mode and context_budget <= 0
+            and reduce_fanout == 2 and map_batch_size == 1
+            and getattr(frtnd, 'stream', False)):
+        aggregated_result = mapreduce_streamed(
             chunks,
             user_question,
             frtnd,
             verbose=verbose,
-            parallelism=parallelism,
+            compact_map_mode=compact_map_mode,
             max_chunk_size=max_chunk_size)
-    elif parallelism > 1:
-        intermediate_results = map_parallel(chunks,
-                                            user_question,
-                                            frtnd,
-                                            verbose=verbose,
-                                            parallelism=parallelism)
-    elif compact_map_mode:
+        return aggregated_result + '\n\n'
+
+    # map phase
+    if compact_map_mode:
         intermediate_results = map_serial_compact(
             chunks,
             user_question,
             frtnd,
             verbose=verbose,
             max_chunk_size=max_chunk_size)
+    elif map_batch_size > 1:
+        intermediate_results = map_serial_batch(chunks,
+                                                user_question,
+                                                frtnd,
+                                                verbose=verbose,
+                                                batch_size=map_batch_size)
     else:
         intermediate_results = map_serial(chunks,
                                           user_question,
                                           frtnd,
                                           verbose=verbose)
+    # release the chunk texts before the reduce phase
+    del chunks
 
     # reduce phase
-    if parallelism > 1 and compact_reduce_mode:
-        aggregated_result = reduce_parallel_compact(
-            intermediate_results,
-            user_question,
-            frtnd,
-            verbose=verbose,
-            parallelism=parallelism,
-            max_chunk_size=max_chunk_size)
-    elif parallelism > 1:
-        aggregated_result = reduce_parallel(intermediate_results,
-                                            user_question,
-                                            frtnd,
-                                            verbose=verbose,
-                                            parallelism=parallelism)
-    elif compact_reduce_mode:
+    if compact_reduce_mode:
         aggregated_result = reduce_serial_compact(
             intermediate_results,
             user_question,
@@ -544,7 +1601,9 @@ def mapreduce_super_long_context(
         aggregated_result = reduce_serial(intermediate_results,
                                           user_question,
                                           frtnd,
-                                          verbose=verbose)
+                                          verbose=verbose,
+                                          context_budget=context_budget,
+                                          fanout=reduce_fanout)
 
     # pad the final result and return
     return aggregated_result + '\n\n'
@@ -581,19 +1640,22 @@ def main(argv: List[str] = sys.argv[1:]):  # pragma: no cover
                         default=1,
                         type=int,
                         help='parallelism')
+    parser.add_argument('--cache-dir',
+                        default=os.path.join(HOME, 'mapreduce_cache'),
+                        type=str,
+                        help='directory of the on-disk answer cache')
+    parser.add_argument('--no-cache',
+                        default=False,
+                        action='store_true',
+                        help='do not load or save cached answers')
     args = parser.parse_args(argv)
 
-    # read the requested files
-    if False:
-        entries = []
-        for file in args.file:
-            entries.extend(
-                reader.read_and_chunk(file, max_chunk_size=args.chunk_size))
-        for entry in entries:
-            console.print(Rule(entry.path))
-            print(entry.wrapfun_chunk(entry.content))
-
     # do the mapreduce
+    if args.no_cache:
+        cache = None
+    else:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        cache = os.path.join(args.cache_dir, 'cache.sqlite')
     f = frontend.EchoFrontend()
     f.lossy_mode = True
     reduced = []
@@ -604,7 +1666,8 @@ def main(argv: List[str] = sys.argv[1:]):  # pragma: no cover
                                               args.ask,
                                               verbose=args.verbose,
                                               compact_reduce_mode=True,
-                                              parallelism=args.parallelism)
+                                              parallelism=args.parallelism,
+                                              cache=cache)
         reduced.append(result)
     console.print(reduced)
 
@@ -14,10 +14,17 @@ GNU Lesser General Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
-from typing import Union, List
-import requests
+from typing import Union, List, Dict, Tuple
+import hashlib
+import json
+import re
 from .defaults import CACHE
 from .cache import Cache
+from ._http import HTTP_TIMEOUT, http_session
+from ._text import strip_trailing_space
+
+# bump this when the format of the cached section index changes
+_INDEX_VERSION = 1
 
 
 class DebianPolicy:
@@ -32,17 +39,42 @@ class DebianPolicy:
 
     def __init__(self) -> None:
         cache = Cache(CACHE)
-        # Check if the cache exists and read lines
-        if self.URL not in cache:  # pragma: no cover
-            r = requests.get(self.URL)
-            cache[self.URL] = r.text
-            lines = r.text.split('\n')
+        # Read the document from the cache, or download it once
+        try:
+            text = cache[self.URL]
+        except KeyError:  # pragma: no cover
+            r = http_session().get(self.URL, timeout=HTTP_TIMEOUT)
+            r.raise_for_status()
+            text = r.text
+            cache[self.URL] = text
+
+        # Keep the document as a single string, and the sections as slices of
+        # it. The section indexes are scanned once, and cached alongside the
+        # document together with the digest of the text they belong to.
+        self.text: str
+        self.indexes: list[str]
+        self.ranges: Dict[str, Tuple[int, int]]
+        digest = hashlib.sha256(text.encode()).hexdigest()
+        try:
+            index = json.loads(cache[self.URL + '#index'])
+        except KeyError:
+            index = {}
+        if index.get('version') == _INDEX_VERSION and index.get(
+                'digest') == digest:
+            self.text = text
+            self.indexes = index['indexes']
+            self.ranges = {k: tuple(v) for (k, v) in index['ranges'].items()}
         else:
-            lines = cache[self.URL].split('\n')
-
-        # Scan the document and prepare the section indexes.
-        self.lines: List[str] = [x.rstrip() for x in lines]
-        self.indexes: list[str] = self.__scan_indexes()
+            self.text = strip_trailing_space(text)
+            self.indexes, self.ranges = self.__scan_indexes()
+            if self.text != text:
+                cache[self.URL] = self.text
+            cache[self.URL + '#index'] = json.dumps({
+                'version': _INDEX_VERSION,
+                'digest': hashlib.sha256(self.text.encode()).hexdigest(),
+                'indexes': self.indexes,
+                'ranges': self.ranges,
+            })
 
     def __iter__(self):
         # Return an iterator over the section indexes.
@@ -62,25 +94,42 @@ class DebianPolicy:
         # Return the number of sections in the document.
         return len(self.indexes)
 
-    def __scan_indexes(self) -> list[str]:
-        # Scan the document and return a list of all section indexes.
+    def __scan_indexes(self) -> Tuple[list[str], Dict[str, Tuple[int, int]]]:
+        # Scan the document and return a list of all section indexes, and
+        # the (start, end) range of every section in the text. A section ends
+        # where the next section of the same or a higher level starts.
+        levels: Dict[str, int] = {
+            self.SEP_SECTION: 1,
+            self.SEP_SUBSECTION: 2,
+            self.SEP_SUBSUBSECTION: 3
+        }
+        # only the separator lines are visited, found by a regex in one pass
+        separator = re.compile('^(?:' + '|'.join(map(re.escape, levels)) + ')',
+                               re.MULTILINE)
         ret: list[str] = []
-        for i in range(1, len(self.lines)):
-            cursur = self.lines[i]
-            previous = self.lines[i - 1]
-            if any(
-                    cursur.startswith(x) for x in [
-                        self.SEP_SECTION, self.SEP_SUBSECTION,
-                        self.SEP_SUBSUBSECTION
-                    ]):
-                index = previous.split(' ')[0]
-                if index.endswith('.'):
-                    ret.append(index.rstrip('.'))
-        return ret
+        ranges: Dict[str, Tuple[int, int]] = {}
+        # the sections being read, as (level, index, start)
+        stack: List[Tuple[int, str, int]] = []
+        for match in separator.finditer(self.text):
+            if match.start() == 0:
+                continue
+            level = levels[match.group()]
+            # the heading line above the separator starts the new section
+            heading = self.text.rfind('\n', 0, match.start() - 1) + 1
+            while stack and stack[-1][0] >= level:
+                _, index, start = stack.pop()
+                ranges.setdefault(index, (start, heading - 1))
+            index = self.text[heading:match.start() - 1].split(' ')[0]
+            if index.endswith('.'):
+                ret.append(index.rstrip('.'))
+                stack.append((level, index.rstrip('.'), heading))
+        for (_, index, start) in stack:
+            ranges.setdefault(index, (start, len(self.text)))
+        return ret, ranges
 
     def __str__(self) -> str:
         # Return the entire document as a string.
-        return '\n'.join(self.lines)
+        return self.text
 
     def __getitem__(self, index: Union[str, int]) -> str:
         # if the index is an integer, map it to the real section number
@@ -88,34 +137,8 @@ class DebianPolicy:
             section = self.indexes[index]
             return self.__getitem__(section)
         # Retrieve a specific section, subsection, or subsubsection based on the index.
-        sep: str = {
-            1: self.SEP_SECTION,
-            2: self.SEP_SUBSECTION,
-            3: self.SEP_SUBSUBSECTION
-        }[len(index.split('.'))]
-
-        ret: list[str] = []
-        prev: str = ''
-        in_range: bool = False
-
-        # Iterate over lines to find the specified section.
-        for cursor in self.lines:
-            if cursor.startswith(sep) and prev.startswith(f'{index}. '):
-                # Start of the desired section
-                ret.append(prev)
-                ret.append(cursor)
-                in_range = True
-            elif cursor.startswith(sep) and in_range:
-                # End of the desired section
-                ret.pop(-1)
-                in_range = False
-                break
-            elif in_range:
-                # Within the desired section
-                ret.append(cursor)
-            prev = cursor
-
-        return '\n'.join(ret)
+        start, end = self.ranges.get(index, (0, 0))
+        return self.text[start:end]
 
 
 class DebianDevref(DebianPolicy):
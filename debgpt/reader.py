@@ -19,15 +19,22 @@ import re
 import requests
 from bs4 import BeautifulSoup
 import argparse
+import bisect
+import codecs
 import io
 import os
 import subprocess
+import tempfile
 import functools as ft
 import itertools as it
 import sys
 import glob
+import multiprocessing
+import threading
+import fnmatch
 import shlex
 import tenacity
+import numpy as np
 from rich.rule import Rule
 from rich.progress import track
 import concurrent.futures
@@ -39,6 +46,8 @@ from .defaults import Config
 from collections import namedtuple
 from .cache import Cache
 from .nm_templates import NM_TEMPLATES
+from ._http import HTTP_TIMEOUT, http_session
+from ._text import strip_space, strip_trailing_space
 
 try:
     import pycurl
@@ -46,6 +55,13 @@ try:
 except ImportError:
     __use_pycurl = False
 
+# the C parser of lxml is several times faster than the pure python one
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
 # The Entry namedtuple, core data structure for reader outputs
 # path: str
 # content: str
@@ -65,7 +81,6 @@ HEADERS = {
 
 GOOGLE_CUSTOM_SEARCH_URL = 'https://www.googleapis.com/customsearch/v1'
 
-
 @ft.lru_cache(maxsize=1)
 def _load_reader_config() -> Optional[Config]:
     try:
@@ -74,6 +89,22 @@ def _load_reader_config() -> Optional[Config]:
         return None
 
 
+@ft.lru_cache(maxsize=1)
+def _load_policy() -> debian_policy.DebianPolicy:
+    '''
+    the Debian Policy document, parsed once and shared by all policy: specs
+    '''
+    return debian_policy.DebianPolicy()
+
+
+@ft.lru_cache(maxsize=1)
+def _load_devref() -> debian_policy.DebianDevref:
+    '''
+    the Debian Developer Reference, parsed once and shared by all devref: specs
+    '''
+    return debian_policy.DebianDevref()
+
+
 def _resolve_google_search_credentials() -> Tuple[Optional[str], Optional[str]]:
     api_key = os.getenv('GOOGLE_SEARCH_API_KEY') or os.getenv('GOOGLE_API_KEY')
     search_cx = os.getenv('GOOGLE_SEARCH_CX') or os.getenv('GOOGLE_CSE_ID')
@@ -164,28 +195,50 @@ def enable_cache(func: callable) -> callable:
         callable: the wrapper function
     '''
 
+    # results already seen by this process, so that repeated reads of the
+    # same resource do not even open the sqlite database
+    memo: Dict[str, str] = {}
+
+    @ft.wraps(func)
     def wrapper(*args, **kwargs):
+        if args[0] in memo:
+            return memo[args[0]]
         cache = Cache(CACHE)
-        if args[0] in cache:
-            return cache[args[0]]
-        result = func(*args, **kwargs)
-        cache[args[0]] = result
+        try:
+            result = cache[args[0]]
+        except KeyError:
+            result = func(*args, **kwargs)
+            cache[args[0]] = result
+        memo[args[0]] = result
         return result
 
     return wrapper
 
 
+# the line of the BTS page after which everything is useless
+_BTS_OPTIONS = re.compile(r'^Options$', re.MULTILINE)
+# runs of two or more blank lines in the text extracted from HTML
+_BLANK_LINES = re.compile(r'\n{3,}')
+
+# Below this number of pages per worker, extracting the text of a PDF in a
+# process pool costs more than it saves.
+_PDF_PROCESS_POOL_MIN_PAGES = 32
+_SNIFF_SIZE = 8192
+# PDF downloads larger than this are spooled to disk instead of memory
+_PDF_SPOOL_SIZE = 16 << 20
+
+
 def entry2dict(
-        entry: Entry,
-        max_chunk_size: int = 8192) -> Dict[Tuple[str, int, int], List[str]]:
+    entry: Entry,
+    max_chunk_size: int = 8192,
+    out: Optional[Dict[Tuple[str, int, int], List[str]]] = None
+) -> Dict[Tuple[str, int, int], List[str]]:
     '''
-    convert an Entry object to a chunked dictionary
+    convert an Entry object to a chunked dictionary. When `out` is given,
+    the chunks are inserted into it in place and it is returned.
     '''
-    try:
-        d = chunk_lines(entry.content.split('\n'), max_chunk_size)
-    except RecursionError:
-        d = chunk_lines_nonrecursive(entry.content.split('\n'), max_chunk_size)
-    result = {}
+    d = chunk_lines(entry.content.split('\n'), max_chunk_size)
+    result = {} if out is None else out
     for (start, end), lines in d.items():
         result[(entry.path, start, end)] = lines
     return result
@@ -203,8 +256,10 @@ def entries2dict(
     Returns:
         a dictionary of chunked contents
     '''
-    return ft.reduce(dict.__or__,
-                     [entry2dict(e, max_chunk_size) for e in entries])
+    result: Dict[Tuple[str, int, int], List[str]] = {}
+    for e in entries:
+        entry2dict(e, max_chunk_size, out=result)
+    return result
 
 
 def latest_file(files: List[str]) -> str:
@@ -217,28 +272,65 @@ def latest_file(files: List[str]) -> str:
 
 def latest_glob(pattern: str) -> str:
     '''
-    return the latest file that matches the glob pattern
+    return the latest file that matches the glob pattern. When only the
+    basename has wildcards, the directory is scanned once and the mtimes come
+    along with the entries, instead of a glob followed by a stat per match.
     '''
-    return latest_file(glob.glob(pattern))
+    dirname, basename = os.path.split(pattern)
+    if glob.has_magic(dirname):
+        return latest_file(glob.glob(pattern))
+    # like glob, hidden files only match a pattern starting with a dot
+    hidden = basename.startswith('.')
+    try:
+        with os.scandir(dirname or os.curdir) as entries:
+            matches = [(x.stat().st_mtime, x.name) for x in entries
+                       if (hidden or not x.name.startswith('.'))
+                       and fnmatch.fnmatch(x.name, basename)]
+    except FileNotFoundError:
+        matches = []
+    return os.path.join(dirname, max(matches)[1])
 
 
 def is_text_file(filepath: str) -> bool:
     '''
-    check if the file is a text file
+    check if the file is a text file, by sniffing only its first few KiB.
+    read_file does not call this, and decodes what it has read instead.
 
     Args:
         filepath (str): the path to the file
     Returns:
         bool: True if the file is a text file, False otherwise
     '''
+    with open(filepath, 'rb') as f:
+        head = f.read(_SNIFF_SIZE)
+    if b'\x00' in head:
+        return False
+    # the head may end in the middle of a multi-byte character
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            f.read()
-            return True
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return True
     except UnicodeDecodeError:
         return False
 
 
+def decode_text(data: bytes) -> str:
+    '''
+    decode the raw file content as utf-8 text, with the same newline
+    translation as opening the file in text mode.
+
+    Args:
+        data (bytes): the raw content
+    Returns:
+        str: the decoded text
+    Raises:
+        UnicodeDecodeError: if the content is not utf-8 text
+    '''
+    text = data.decode('utf-8')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
 def read_file_plaintext(path: str) -> str:
     '''
     read the file and return the content as a string
@@ -316,6 +408,17 @@ def read_file_pdf(path: str) -> str:
     Returns:
         str: the content of the PDF file
     '''
+    # text extraction is slow. Cache it by the identity of the file content.
+    stat = os.stat(path)
+    key = f'pdf:{os.path.realpath(path)}:{stat.st_mtime_ns}:{stat.st_size}'
+    return _extract_pdf_text(key, path)
+
+
+@enable_cache
+def _extract_pdf_text(key: str, path: str) -> str:
+    '''
+    extract the text of the PDF file. The key only serves the cache.
+    '''
     try:
         from pypdf import PdfReader
     except ImportError:
@@ -323,14 +426,35 @@ def read_file_pdf(path: str) -> str:
         exit(1)
     # Load the PDF file
     reader = PdfReader(path)
-    # Get the number of pages
-    num_pages = len(reader.pages)
-    # Extract text from each page
-    text = ""
-    for page_number in range(num_pages):
-        page = reader.pages[page_number]
-        text += page.extract_text()
-    return text
+    npages = len(reader.pages)
+    nworkers = min(os.cpu_count() or 1, npages // _PDF_PROCESS_POOL_MIN_PAGES)
+    # the thread pools of read_directory and read_many already read several
+    # files at once. Fanning out from each of them would start a process pool
+    # per thread.
+    if nworkers < 2 or (threading.current_thread()
+                        is not threading.main_thread()):
+        # Extract text from each page
+        return ''.join(page.extract_text() for page in reader.pages)
+    # pypdf is pure python code holding the GIL. Let every worker process
+    # open the file on its own and extract a contiguous range of pages. The
+    # workers are spawned, as forking a process with threads is unsafe.
+    bounds = [npages * i // nworkers for i in range(nworkers + 1)]
+    with concurrent.futures.ProcessPoolExecutor(
+            nworkers,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        return ''.join(
+            executor.map(_extract_pdf_pages, it.repeat(path), bounds[:-1],
+                         bounds[1:]))
+
+
+def _extract_pdf_pages(path: str, start: int, end: int) -> str:
+    '''
+    extract the text of pages [start, end) of the PDF file. This is a
+    module-level function so that it can be sent to a process pool.
+    '''
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return ''.join(reader.pages[i].extract_text() for i in range(start, end))
 
 
 def read_file(path: str) -> str:
@@ -342,9 +466,14 @@ def read_file(path: str) -> str:
     Returns:
         str: the content of the file
     '''
-    if is_text_file(path):
-        return read_file_plaintext(path)
-    elif path.lower().endswith('.pdf'):
+    # read the file only once, and sniff the type from what we have read
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        return decode_text(data)
+    except UnicodeDecodeError:
+        pass
+    if path.lower().endswith('.pdf'):
         return read_file_pdf(path)
     else:
         raise TypeError(f'Unsupported file type: {path}')
@@ -361,19 +490,24 @@ def read_directory(path: str) -> List[Tuple[str, str]]:
         and the content
     '''
     SKIPLIST = ('.git', '__pycache__')
-    contents: List[Tuple[str, str]] = []
+    cursors: List[str] = []
     for root, _, files in os.walk(path):
         if any(x in root.split('/') for x in SKIPLIST):
             continue
-        for file in files:
-            cursor = os.path.join(root, file)
-            try:
-                content = read_file(cursor)
-            except TypeError:
-                console.log(f'Skipping unsupported file `{path}`.')
-                content = ''
-            contents.append((cursor, content))
-    return contents
+        cursors.extend(os.path.join(root, file) for file in files)
+
+    def _read(cursor: str) -> str:
+        try:
+            return read_file(cursor)
+        except TypeError:
+            console.log(f'Skipping unsupported file `{cursor}`.')
+            return ''
+
+    # the files are independent and reading them is I/O bound
+    if len(cursors) < 2:
+        return [(x, _read(x)) for x in cursors]
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        return list(zip(cursors, executor.map(_read, cursors)))
 
 
 @enable_cache
@@ -459,11 +593,10 @@ def read_url__pycurl(url: str) -> str:
         # console.log(f'Content-Type: {headers}')
         # if HTML, parse it
         if _is_content_type_html(headers):
-            soup = BeautifulSoup(content, features='html.parser')
+            soup = BeautifulSoup(content, features=HTML_PARSER)
             text = soup.get_text().strip()
-            text = re.sub('\n\n+\n', '\n\n', text)
-            text = [x.rstrip() for x in text.split('\n')]
-            content = '\n'.join(text)
+            text = _BLANK_LINES.sub('\n\n', text)
+            content = strip_trailing_space(text)
         return content
     except UnicodeDecodeError:
         if url.endswith('.pdf'):
@@ -474,10 +607,7 @@ def read_url__pycurl(url: str) -> str:
                 return ''
             pdf_bytes = io.BytesIO(buffer.getvalue())
             reader = PdfReader(pdf_bytes)
-            text = ''
-            for page in reader.pages:
-                text += page.extract_text()
-            return text
+            return ''.join(page.extract_text() for page in reader.pages)
         else:
             console.print(f'Failed to read {repr(url)} as utf-8. Giving up.')
             return ''
@@ -509,28 +639,33 @@ def read_url__requests(url: str) -> str:
         }
     else:
         headers = HEADERS
-    response = requests.get(url, headers=headers)
+    response = http_session().get(url, headers=headers,
+                                  timeout=HTTP_TIMEOUT,
+                                  stream=url.endswith('.pdf'))
     if response.status_code != 200:
+        response.close()
         raise ValueError(f'Failed to read {url}')
     # dispatch content type
     if url.endswith('.pdf'):
         try:
             from pypdf import PdfReader
         except ImportError:
+            response.close()
             console.log('Please install pypdf using `pip install pypdf`')
             return ''
-        pdf_bytes = io.BytesIO(response.content)
-        reader = PdfReader(pdf_bytes)
-        text = ''
-        for page in reader.pages:
-            text += page.extract_text()
-        return text
+        # stream the download into a file, which only spills over to disk
+        # when it is large, instead of holding the whole body in memory
+        with tempfile.SpooledTemporaryFile(max_size=_PDF_SPOOL_SIZE) as f:
+            for chunk in response.iter_content(1 << 16):
+                f.write(chunk)
+            f.seek(0)
+            reader = PdfReader(f)
+            return ''.join(page.extract_text() for page in reader.pages)
     elif response.headers['Content-Type'].startswith('text/html'):
-        soup = BeautifulSoup(response.text, features='html.parser')
+        soup = BeautifulSoup(response.text, features=HTML_PARSER)
         text = soup.get_text().strip()
-        text = re.sub('\n\n+\n', '\n\n', text)
-        text = [x.rstrip() for x in text.split('\n')]
-        content = '\n'.join(text)
+        text = _BLANK_LINES.sub('\n\n', text)
+        content = strip_trailing_space(text)
     else:
         # assume plain text, but it may not be utf-8
         try:
@@ -545,8 +680,7 @@ def read_cmd(cmd: Union[str, List]) -> str:
     if isinstance(cmd, str):
         cmd = shlex.split(cmd)
     stdout = subprocess.check_output(cmd).decode()
-    lines = [x.rstrip() for x in stdout.split('\n')]
-    return '\n'.join(lines)
+    return strip_trailing_space(stdout)
 
 
 @enable_cache
@@ -560,27 +694,22 @@ def read_bts(spec: str) -> str:
         str: the content of the bug report
     '''
     url = f'https://bugs.debian.org/{spec}'
-    r = requests.get(url)
-    soup = BeautifulSoup(r.text, features="html.parser")
+    r = http_session().get(url, timeout=HTTP_TIMEOUT)
+    soup = BeautifulSoup(r.text, features=HTML_PARSER)
     if not spec.startswith('src:'):
-        # delete useless system messages
-        _ = [
-            x.clear()
-            for x in soup.find_all('p', attrs={'class': 'msgreceived'})
-        ]
-        _ = [
-            x.clear()
-            for x in soup.find_all('div', attrs={'class': 'infmessage'})
-        ]
+        # delete useless system messages, in a single walk over the tree
+        for x in soup.select('p.msgreceived, div.infmessage'):
+            x.decompose()
     text = soup.get_text().strip()
-    text = re.sub('\n\n+\n', '\n\n', text)
-    text = [x.strip() for x in text.split('\n')]
+    text = strip_space(_BLANK_LINES.sub('\n\n', text))
 
     # filter out useless information from the webpage
     if spec.startswith('src:'):
         # the lines from 'Options' to the end are useless
-        text = text[:text.index('Options')]
-    return '\n'.join(text)
+        options = _BTS_OPTIONS.search(text)
+        if options is not None:
+            text = text[:options.start()].removesuffix('\n')
+    return text
 
 
 def fetch_ldo_threads(spec: str, index: str = 'threads.html') -> List[str]:
@@ -636,16 +765,16 @@ def fetch_ldo_threads(spec: str, index: str = 'threads.html') -> List[str]:
         # calculate the product
         allcombs = it.product(name, year, month)
         allcombs = ['/'.join(x) for x in allcombs]
-        urls = ft.reduce(
-            list.__add__, [fetch_ldo_threads(x) for x in allcombs])
+        urls = list(
+            it.chain.from_iterable(fetch_ldo_threads(x) for x in allcombs))
         return urls
 
     url = f'https://lists.debian.org/{spec}/{index}'
-    response = requests.get(url)
+    response = http_session().get(url, timeout=HTTP_TIMEOUT)
     if response.status_code != 200:
         console.log(f'Failed to read {url}: HTTP {response.status_code}')
         return list()
-    soup = BeautifulSoup(response.text, features='html.parser')
+    soup = BeautifulSoup(response.text, features=HTML_PARSER)
     links = soup.find_all('a', href=re.compile(r'^msg.*'))
     links = [x.get('href') for x in links]
     urls = [f'https://lists.debian.org/{spec}/{x}' for x in links]
@@ -671,8 +800,7 @@ def read_ldo_threads(spec: str) -> List[Tuple[str, str]]:
 
 
 def read_stdin() -> str:
-    lines = [x.rstrip() for x in sys.stdin.readlines()]
-    return '\n'.join(lines)
+    return strip_trailing_space(sys.stdin.read().removesuffix('\n'))
 
 
 def google_search(query: str) -> List[str]:
@@ -695,9 +823,9 @@ def google_search(query: str) -> List[str]:
         'q': query,
     }
     try:
-        response = requests.get(GOOGLE_CUSTOM_SEARCH_URL,
-                                params=params,
-                                timeout=10)
+        response = http_session().get(GOOGLE_CUSTOM_SEARCH_URL,
+                                      params=params,
+                                      timeout=10)
         response.raise_for_status()
     except requests.RequestException as exc:
         console.log(f'Google Custom Search request failed: {exc}')
@@ -748,19 +876,17 @@ def read_archwiki(spec: str) -> str:  # pragma: no cover
         str: the content of the ArchWiki page
     '''
     url = f'https://wiki.archlinux.org/title/{spec}'
-    r = requests.get(url, headers=HEADERS)
-    soup = BeautifulSoup(r.text, features='html.parser')
-    text = soup.get_text().split('\n')
-    return '\n'.join([x.rstrip() for x in text])
+    r = http_session().get(url, headers=HEADERS, timeout=HTTP_TIMEOUT)
+    soup = BeautifulSoup(r.text, features=HTML_PARSER)
+    return strip_trailing_space(soup.get_text())
 
 
 @enable_cache
 def read_buildd(spec: str):  # pragma: no cover
     url = f'https://buildd.debian.org/status/package.php?p={spec}'
-    r = requests.get(url, headers=HEADERS)
-    soup = BeautifulSoup(r.text, features='html.parser')
-    text = soup.get_text().split('\n')
-    return '\n'.join([x.rstrip() for x in text])
+    r = http_session().get(url, headers=HEADERS, timeout=HTTP_TIMEOUT)
+    soup = BeautifulSoup(r.text, features=HTML_PARSER)
+    return strip_trailing_space(soup.get_text())
 
 
 def read(spec: str,
@@ -790,9 +916,7 @@ def read(spec: str,
         '''
 
         def _wrapper(content: str) -> str:
-            lines = [template.format(spec)]
-            lines.extend(['```'] + content.split('\n') + ['```', ''])
-            return '\n'.join(lines)
+            return f'{template.format(spec)}\n```\n{content}\n```\n'
 
         return _wrapper
 
@@ -803,9 +927,8 @@ def read(spec: str,
         '''
 
         def _wrapper(content: str, start: int, end: int) -> str:
-            lines = [template.format(spec, start, end)]
-            lines.extend(['```'] + content.split('\n') + ['```', ''])
-            return '\n'.join(lines)
+            header = template.format(spec, start, end)
+            return f'{header}\n```\n{content}\n```\n'
 
         return _wrapper
 
@@ -814,14 +937,14 @@ def read(spec: str,
     if spec in (':', '?'):
         help()
         raise SystemExit()
-    elif os.path.exists(spec) and os.path.isfile(spec):
+    elif os.path.isfile(spec):
         parsed_spec = spec
         content = read_file(spec)
         wrapfun = create_wrapper('Here is the contents of file `{}`:', spec)
         wrapfun_chunk = create_chunk_wrapper(
             'Here is the contents of file {} (lines {}-{}):', spec)
         results.append(Entry(parsed_spec, content, wrapfun, wrapfun_chunk))
-    elif os.path.exists(spec) and os.path.isdir(spec):
+    elif os.path.isdir(spec):
         parsed_spec = spec
         contents = read_directory(spec)
         for (fpath, fcontent) in contents:
@@ -831,7 +954,7 @@ def read(spec: str,
                 'Here is the contents of file {} (lines {}-{}):', fpath)
             entry = Entry(fpath, fcontent, wrapfun, wrapfun_chunk)
             results.append(entry)
-    elif any(spec.startswith(x) for x in ('file://', 'http://', 'https://')):
+    elif spec.startswith(('file://', 'http://', 'https://')):
         parsed_spec = spec
         content = read_url(spec)
         wrapfun = create_wrapper('Here is the contents of URL {}:', spec)
@@ -909,7 +1032,7 @@ def read(spec: str,
     elif spec.startswith('devref:'):
         # e.g., devref:1 loads section 1, devref: loads the whole devref
         parsed_spec = spec[7:]
-        content = debian_policy.DebianDevref()
+        content = _load_devref()
         if parsed_spec == 'all':
             source = 'Debian Developer Reference document'
             wrapfun = create_wrapper(
@@ -950,7 +1073,7 @@ def read(spec: str,
             wrapfun_chunk = create_chunk_wrapper(
                 'Here is the contents from URL `{}` (lines {}-{}):', url)
             results.append((url, content, wrapfun, wrapfun_chunk))
-    elif spec.startswith('ldo:') or spec.startswith('lists.debian.org:'):
+    elif spec.startswith(('ldo:', 'lists.debian.org:')):
         parsed_spec = spec[4:] if spec.startswith('ldo:') else spec[18:]
         pairs = read_ldo_threads(parsed_spec)
         for url, content in pairs:
@@ -969,7 +1092,7 @@ def read(spec: str,
     elif spec.startswith('policy:'):
         # e.g., policy:1 loads section 1, policy: loads the whole policy
         parsed_spec = spec[7:]
-        content = debian_policy.DebianPolicy()
+        content = _load_policy()
         if parsed_spec == 'all':
             source = 'Debian Policy document'
             wrapfun = create_wrapper('Here is the Debian Policy document, {}:',
@@ -1032,53 +1155,61 @@ def read(spec: str,
     return results
 
 
-def chunk_lines(
-    lines: List[str],
-    max_chunk_size: int,
-    start: int = -1,
-    end: int = -1,
-) -> Dict[Tuple[int, int], List[str]]:
+def _line_offsets(lines: List[str]) -> List[int]:
+    '''
+    prefix sums of the UTF-8 sizes of the lines, each counted with its line
+    break. The size of '\n'.join(lines[start:end]) in bytes is then
+    offsets[end] - offsets[start] - 1, without encoding anything again.
     '''
-    Chunk the lines into pieces with the specified size.
+    # ASCII lines, most of source code and build logs, are as long in bytes
+    # as in characters. Only the others are encoded to be measured.
+    return list(
+        it.accumulate(((len(x) if x.isascii() else len(x.encode('utf8'))) + 1
+                       for x in lines),
+                      initial=0))
 
-    Args:
-        lines (List[str]): the lines to chunk, always the full list of lines
-        max_chunk_size (int): the maximum chunk size
-        start (int): the start index of the lines
-        end (int): the end index of the lines
-    Returns:
-        Dict[Tuple[int, int], List[str]]: a dictionary, each key is a tuple
-        containing the start and end index of the chunked lines, and the value
-        is the chunked lines.
+
+def _byte_line_offsets(data: bytes) -> List[int]:
     '''
-    # print('DEBUG:', len(lines), len('\n'.join(lines[start:end]).encode('utf8')),
-    #    'c', max_chunk_size, 'start', start, 'end', end)
-    # deal with the unspecified param case. This allows chunk_lines(lines, 1000)
-    # to work properly without specifying the start and end in another wrapper.
-    if end < 0 and start < 0:
-        return chunk_lines(lines, max_chunk_size, 0, len(lines))
-    # real work
-    chunk_size_in_bytes = len('\n'.join(lines[start:end]).encode('utf8'))
-    if chunk_size_in_bytes <= max_chunk_size:
-        return {(start, end): lines[start:end]}
-    elif end - start == 1:
-        return {(start, end): lines[start:end]}
-    else:
-        # split the lines into chunks
-        middle = (start + end) // 2
-        left = chunk_lines(lines, max_chunk_size, start, middle)
-        right = chunk_lines(lines, max_chunk_size, middle, end)
-        return {**left, **right}
+    the same as _line_offsets(data.decode().split('\n')), computed from the
+    encoded text. The line breaks are located by a vectorized comparison,
+    instead of a python loop over the lines.
+    '''
+    newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 0x0A)
+    return [0, *(newlines + 1).tolist(), len(data) + 1]
 
 
-def chunk_lines_nonrecursive(
+def _chunk_ranges(offsets: List[int], max_chunk_size: int, start: int,
+                  end: int) -> List[Tuple[int, int]]:
+    '''
+    the (start, end) line ranges of the chunks, see chunk_lines(...).
+    '''
+    ranges = []
+    while start < end:
+        # the remaining lines fit in one chunk, e.g., most files at once
+        if offsets[end] - offsets[start] - 1 <= max_chunk_size:
+            ranges.append((start, end))
+            break
+        # the last line whose chunk still fits, counting the line breaks
+        split = bisect.bisect_right(offsets, offsets[start] +
+                                    max_chunk_size + 1, start + 1, end + 1) - 1
+        split = max(split, start + 1)
+        ranges.append((start, split))
+        start = split
+    return ranges
+
+
+def chunk_lines(
     lines: List[str],
     max_chunk_size: int,
     start: int = -1,
     end: int = -1,
 ) -> Dict[Tuple[int, int], List[str]]:
     '''
-    Chunk the lines into pieces with the specified size.
+    Chunk the lines into pieces with the specified size. Every chunk takes
+    as many of the following lines as fit in max_chunk_size, found by a
+    binary search over the prefix sums of the line sizes. A single line
+    longer than that makes a chunk of its own.
 
     Args:
         lines (List[str]): the lines to chunk, always the full list of lines
@@ -1090,29 +1221,12 @@ def chunk_lines_nonrecursive(
         containing the start and end index of the chunked lines, and the value
         is the chunked lines.
     '''
+    # deal with the unspecified param case. This allows chunk_lines(lines, 1000)
+    # to work properly without specifying the start and end in another wrapper.
     if end < 0 and start < 0:
-        return chunk_lines_nonrecursive(lines, max_chunk_size, 0, len(lines))
-    # real work
-    result: Dict[Tuple[int, int], List[str]] = {}
-    stack = [(start, end)]
-    while stack:
-        current_start, current_end = stack.pop()
-        chunk_size_in_bytes = len('\n'.join(
-            lines[current_start:current_end]).encode('utf8'))
-
-        if chunk_size_in_bytes <= max_chunk_size:
-            # if the chunk is within the size limit, we add it to the result
-            result[(current_start,
-                    current_end)] = lines[current_start:current_end]
-        elif current_end - current_start == 1:
-            # if the chunk is too large but cannot be split, we add it to the result
-            result[(current_start,
-                    current_end)] = lines[current_start:current_end]
-        else:
-            middle = (current_start + current_end) // 2
-            stack.append((current_start, middle))
-            stack.append((middle, current_end))
-    return result
+        start, end = 0, len(lines)
+    ranges = _chunk_ranges(_line_offsets(lines), max_chunk_size, start, end)
+    return {(start, end): lines[start:end] for (start, end) in ranges}
 
 
 def chunk_entry(entry: Entry, max_chunk_size: int) -> List[Entry]:
@@ -1128,9 +1242,21 @@ def chunk_entry(entry: Entry, max_chunk_size: int) -> List[Entry]:
     if max_chunk_size < 0:
         return [entry]
     results = []
-    chunkdict = chunk_lines(entry.content.split('\n'), max_chunk_size)
-    for (start, end), lines in chunkdict.items():
-        content = '\n'.join(lines)
+    data = entry.content.encode('utf8')
+    # the whole entry fits in one chunk, as most files do. Keep the content
+    # as is, without locating the line breaks.
+    if len(data) <= max_chunk_size:
+        wrapfun = ft.partial(entry.wrapfun_chunk,
+                             start=0,
+                             end=entry.content.count('\n') + 1)
+        return [Entry(entry.path, entry.content, wrapfun, wrapfun)]
+    offsets = _byte_line_offsets(data)
+    ranges = _chunk_ranges(offsets, max_chunk_size, 0, len(offsets) - 1)
+    # slice the chunks out of the encoded content, instead of copying the
+    # lines into sublists and joining them again. The chunks end at line
+    # breaks, hence decode cleanly.
+    for (start, end) in ranges:
+        content = data[offsets[start]:offsets[end] - 1].decode('utf8')
         wrapfun = ft.partial(entry.wrapfun_chunk, start=start, end=end)
         results.append(Entry(entry.path, content, wrapfun, wrapfun))
     return results
@@ -1152,10 +1278,15 @@ def read_and_chunk(spec: str,
         List[Entry]: a list of entries, each entry contains a chunk of the content
     '''
     entries = read(spec, user_question=user_question)
-    if max_chunk_size > 0:
-        entries = ft.reduce(list.__add__,
-                            [chunk_entry(x, max_chunk_size) for x in entries])
-    return entries
+    if max_chunk_size <= 0:
+        return entries
+    # drop every entry once it is chunked, so that the whole corpus is not
+    # held twice, as entries and as chunks, at the peak
+    entries.reverse()
+    chunks: List[Entry] = []
+    while entries:
+        chunks.extend(chunk_entry(entries.pop(), max_chunk_size))
+    return chunks
 
 
 def read_and_wrap(spec: str,
@@ -1176,12 +1307,36 @@ def read_and_wrap(spec: str,
     '''
     entries = read(spec, user_question=user_question)
     if max_chunk_size > 0:
-        entries = ft.reduce(list.__add__,
-                            [chunk_entry(x, max_chunk_size) for x in entries])
-    wrapped: str = ''
-    for entry in entries:
-        wrapped += entry.wrapfun(entry.content)
-    return wrapped
+        entries = list(
+            it.chain.from_iterable(
+                chunk_entry(x, max_chunk_size) for x in entries))
+    return ''.join(entry.wrapfun(entry.content) for entry in entries)
+
+
+def read_many(specs: List[str],
+              *,
+              max_chunk_size: int = -1,
+              user_question: Optional[str] = None,
+              ) -> List[str]:
+    '''
+    Read and wrap several resources concurrently, see read_and_wrap(...).
+    Most readers wait on the network or on a subprocess, so the total
+    latency is about the slowest spec instead of the sum of them.
+
+    Args:
+        specs (List[str]): the paths or URLs to read
+        max_chunk_size (int): the maximum chunk size of the content
+    Returns:
+        List[str]: the wrapped contents, in the order of the specs
+    '''
+    func = ft.partial(read_and_wrap,
+                      max_chunk_size=max_chunk_size,
+                      user_question=user_question)
+    if len(specs) < 2:
+        return [func(x) for x in specs]
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(16, len(specs))) as executor:
+        return list(executor.map(func, specs))
 
 
 def main(argv: List[str] = sys.argv[1:]):
@@ -1210,8 +1365,8 @@ def main(argv: List[str] = sys.argv[1:]):
 
     tally = 0
     if args.wrap:
-        for file in args.file:
-            string = read_and_wrap(file, max_chunk_size=args.chunk)
+        strings = read_many(args.file, max_chunk_size=args.chunk)
+        for file, string in zip(args.file, strings):
             console.print(Rule())
             console.log('Specifier:', file)
             console.print(string)
@@ -1221,9 +1376,9 @@ def main(argv: List[str] = sys.argv[1:]):
         for file in args.file:
             entries = read(file)
             if args.chunk > 0:
-                entries = ft.reduce(
-                    list.__add__,
-                    [chunk_entry(x, args.chunk) for x in entries])
+                entries = list(
+                    it.chain.from_iterable(
+                        chunk_entry(x, args.chunk) for x in entries))
             console.print(Rule())
             console.log('Specifier:', file)
             console.print(entries)
@@ -1,5 +1,13 @@
 """FastAPI-based vector store microservice for DebGPT."""
 
-from .app import create_app  # re-export for convenience
-
 __all__ = ["create_app"]
+
+
+def __getattr__(name: str):
+    # Re-export create_app lazily: importing the app pulls in FastAPI and the
+    # storage backends, which the CLI only needs for the HTTP client.
+    if name == "create_app":
+        from .app import create_app
+
+        return create_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -24,6 +24,8 @@ from debgpt.cache import Cache
 def test_cache_init(tmpdir):
     db_path = str(tmpdir.join('test.db'))
     cache = Cache(db_path)
+    cache.cursor.execute('PRAGMA journal_mode')
+    assert cache.cursor.fetchone()[0] == 'wal'
     cache.close()
 
 
@@ -29,3 +29,27 @@ from debgpt.cli import main
 #def test_cli_system_exit(cmd: str):
 #    with pytest.raises(SystemExit):
 #        main(cmd.split())
+
+
+def test_mapreduce_cache_option(tmpdir, monkeypatch):
+    from debgpt import arguments, cli, mapreduce
+    cache = str(tmpdir.join('sub', 'cache.sqlite'))
+    cmd = [
+        '-F', 'dryrun', '-x', 'spec', '--mapreduce_cache', cache,
+        '--mapreduce_dedup'
+    ]
+    ag = arguments.parse_args(cmd)
+    ag.frontend_instance = None
+    received = {}
+
+    def _mapreduce(*args, **kwargs):
+        received.update(kwargs)
+        return 'aggregated'
+
+    monkeypatch.setattr(mapreduce, 'mapreduce_super_long_context', _mapreduce)
+    msg = cli.gather_information_ordered(None, ag,
+                                         arguments.parse_args_order(cmd))
+    assert 'aggregated' in msg
+    assert received['cache'] == cache
+    assert received['dedup'] is True
+    assert tmpdir.join('sub').isdir()
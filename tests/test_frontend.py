@@ -118,3 +118,126 @@ def test_vector_context_injection(tmp_path):
     assert len(fake_client.saved) == 2
     assert fake_client.saved[-1]['role'] == 'assistant'
     assert frontend_instance._vector_context_prompt is None
+
+
+def test_shared_openai_client():
+    from debgpt._clients import get_openai_client
+    a = get_openai_client('http://localhost:1234/v1', 'no-key-required')
+    b = get_openai_client('http://localhost:1234/v1', 'no-key-required')
+    c = get_openai_client('http://localhost:5678/v1', 'no-key-required')
+    assert a is b
+    assert a is not c
+
+
+def test_shared_async_openai_client():
+    import asyncio
+    from debgpt import _clients
+
+    async def _get():
+        a = await _clients.get_async_openai_client('http://localhost:1234/v1',
+                                                   'no-key-required')
+        b = await _clients.get_async_openai_client('http://localhost:1234/v1',
+                                                   'no-key-required')
+        assert a is b
+        return a
+
+    first = _clients.run(_get())
+    second = _clients.run(_get())
+    # every loop has its own client, closed before the loop is closed
+    assert first is not second
+    assert first.is_closed() and second.is_closed()
+    assert not _clients._ASYNC_OPENAI_CLIENTS
+    # the clients of a loop run otherwise are closed at exit
+    loop = asyncio.new_event_loop()
+    try:
+        third = loop.run_until_complete(_get())
+        assert not third.is_closed()
+        _clients.close_clients()
+        assert third.is_closed()
+        assert not _clients._ASYNC_OPENAI_CLIENTS
+    finally:
+        loop.close()
+
+
+def test_openai_sampling_retry(monkeypatch):
+    import asyncio
+    calls = []
+
+    class _Completions:
+
+        def create(self, **kwargs):
+            calls.append(kwargs)
+            if 'temperature' in kwargs:
+                raise ValueError('temperature is not supported')
+            message = SimpleNamespace(content=kwargs['messages'][-1]['content'])
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    class _AsyncCompletions(_Completions):
+
+        async def create(self, **kwargs):
+            return super().create(**kwargs)
+
+    def _client(completions):
+        return SimpleNamespace(chat=SimpleNamespace(completions=completions),
+                               base_url='http://localhost:1234/v1',
+                               api_key='no-key-required')
+
+    async def _get_async_client(base_url, api_key):
+        return _client(_AsyncCompletions())
+
+    monkeypatch.setattr(frontend, 'get_async_openai_client', _get_async_client)
+    f = object.__new__(frontend.OpenAIFrontend)
+    f.client = _client(_Completions())
+    f.model = 'model'
+    f.verbose = False
+    # both the sync and the async paths drop the rejected sampling params
+    for oneshot in (f.oneshot, lambda x: asyncio.run(f.aoneshot(x))):
+        calls.clear()
+        f.kwargs = {'temperature': 0.5}
+        f._sampling_params_supported = None
+        assert oneshot('hello') == 'hello'
+        assert [('temperature' in x) for x in calls] == [True, False]
+        assert f.kwargs == {} and f._sampling_params_supported is False
+
+
+def test_zmq_frontend_concurrent_oneshot(tmp_path):
+    zmq = pytest.importorskip('zmq')
+    import threading
+    import concurrent.futures
+
+    socket = zmq.Context.instance().socket(zmq.REP)
+    port = socket.bind_to_random_port('tcp://127.0.0.1')
+
+    def _backend(n: int):
+        for _ in range(n):
+            messages = socket.recv_json()
+            reply = messages + [{
+                'role': 'assistant',
+                'content': messages[-1]['content'].upper()
+            }]
+            socket.send_json(reply)
+        socket.close()
+
+    questions = [f'question {i}' for i in range(8)]
+    backend = threading.Thread(target=_backend, args=(len(questions), ))
+    backend.start()
+
+    args = SimpleNamespace(
+        debgpt_home=str(tmp_path),
+        monochrome=False,
+        multiline=False,
+        render_markdown=False,
+        vertical_overflow='visible',
+        verbose=False,
+        zmq_backend=f'tcp://127.0.0.1:{port}',
+    )
+    f = frontend.ZMQFrontend(args)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as ex:
+        answers = list(ex.map(f.oneshot, questions))
+    backend.join(timeout=10)
+    assert answers == [q.upper() for q in questions]
+    f.close()
+    assert not f._io_thread.is_alive()
+    assert f._socket.closed
+    # closing twice is harmless
+    f.close()
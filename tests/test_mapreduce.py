@@ -20,11 +20,12 @@ from debgpt import mapreduce
 from debgpt import frontend
 from debgpt import reader
 import os
-import time
 import numpy as np
 import sys
 import io
 import itertools as it
+import asyncio
+import threading
 
 
 @pytest.fixture
@@ -34,6 +35,17 @@ def frtnd():
     return f
 
 
+@pytest.fixture
+def oneshot_calls(frtnd) -> List[str]:
+    '''
+    record the messages of every oneshot() call to the frtnd fixture
+    '''
+    calls = []
+    oneshot = frtnd.oneshot
+    frtnd.oneshot = lambda message: calls.append(message) or oneshot(message)
+    return calls
+
+
 @pytest.fixture
 def chunk():
     return reader.Entry(
@@ -48,6 +60,8 @@ def chunk():
 def test_shorten():
     string = 'a b c d e f g h i j k l m n o p q r s t u v w x y z' * 1000
     assert len(mapreduce.shorten(string)) <= 100
+    assert mapreduce.shorten(string).endswith(string[-50:])
+    assert mapreduce.shorten('short string') == 'short string'
 
 
 def test_pad_chunk_before_map(chunk):
@@ -187,10 +201,12 @@ def test_reduce_parallel_compact(frtnd):
 
 
 @pytest.mark.parametrize(
-    'parallel,compact_map,compact_reduce,repeat,max_chunk_size',
-    it.product([1, 2, 4], [True, False], [True, False], [1, 100], [20, 100]))
+    'parallel,compact_map,compact_reduce,rolling,repeat,max_chunk_size',
+    it.product([1, 2, 4], [True, False], [True, False], [True, False],
+               [1, 100], [20, 100]))
 def test_mapreduce_super_long_context(tmpdir, frtnd, parallel, compact_map,
-                                      compact_reduce, repeat, max_chunk_size):
+                                      compact_reduce, rolling, repeat,
+                                      max_chunk_size):
     text = ['a b c d e f g h i j k l m n o p q r s t u v w x y z'] * repeat
     text = '\n'.join(text)
     with open(tmpdir / 'test.txt', 'wt') as f:
@@ -207,7 +223,365 @@ def test_mapreduce_super_long_context(tmpdir, frtnd, parallel, compact_map,
         compact_map_mode=compact_map,
         compact_reduce_mode=compact_reduce,
         parallelism=parallel,
+        rolling_mode=rolling,
     )
     assert isinstance(aggregated, str)
     assert aggregated
     assert len(aggregated) > 0
+
+
+@pytest.mark.parametrize('parallel', [0, 1, 4])
+def test_mapreduce_super_long_context_cache(tmpdir, frtnd, parallel,
+                                            oneshot_calls):
+    text = '\n'.join(['a b c d e f g h i j k l m n o p q r s t u v w x y z'] *
+                     100)
+    with open(tmpdir / 'test.txt', 'wt') as f:
+        f.write(text)
+    spec = tmpdir.join('test.txt').strpath
+    cache = tmpdir.join('cache.sqlite').strpath
+    kwargs = dict(spec=spec,
+                  max_chunk_size=100,
+                  frtnd=frtnd,
+                  user_question='test question',
+                  parallelism=parallel,
+                  cache=cache,
+                  rpm=60000)
+    first = mapreduce.mapreduce_super_long_context(**kwargs)
+    assert len(oneshot_calls) > 0
+    ncalls = len(oneshot_calls)
+    second = mapreduce.mapreduce_super_long_context(**kwargs)
+    assert second == first
+    assert len(oneshot_calls) == ncalls
+    assert os.path.exists(tmpdir.join('cache.jsonl').strpath)
+
+
+def test_map_parallel_generator(frtnd, chunk):
+    chunks = (chunk for _ in range(10))
+    results = mapreduce.map_parallel(chunks,
+                                     'test question',
+                                     frtnd,
+                                     parallelism=3)
+    assert len(results) == 10
+    assert all(r == results[0] for r in results)
+
+
+def test_mapreduce_rolling(frtnd, chunk, oneshot_calls):
+    result = mapreduce.mapreduce_rolling([chunk] * 5, 'test question', frtnd)
+    assert isinstance(result, str)
+    assert result
+    assert len(oneshot_calls) == 5
+
+
+def test_map_chunk_retry_transient(frtnd, chunk):
+    import httpx
+    import openai
+    import tenacity
+    failures = [openai.APIConnectionError(request=httpx.Request('POST', 'x'))]
+    oneshot = frtnd.oneshot
+
+    def _flaky(message):
+        if failures:
+            raise failures.pop()
+        return oneshot(message)
+
+    frtnd.oneshot = _flaky
+    map_chunk = mapreduce.map_chunk.retry_with(wait=tenacity.wait_none())
+    result = map_chunk(chunk, 'test question', frtnd)
+    assert isinstance(result, str)
+    assert result
+    assert not failures
+
+
+def test_token_budget_limiter(frtnd, chunk):
+    import asyncio
+    limiter = mapreduce.TokenBudgetLimiter(100)
+    budgeted = mapreduce.BudgetedFrontend(frtnd, limiter)
+    peak = []
+
+    async def _aoneshot(message):
+        peak.append(limiter.used)
+        await asyncio.sleep(0.01)
+        return frtnd.oneshot(message)
+
+    frtnd.aoneshot = _aoneshot
+    results = mapreduce.map_parallel([chunk] * 10,
+                                     'test question',
+                                     budgeted,
+                                     parallelism=8)
+    assert len(results) == 10
+    assert max(peak) <= 100
+    assert limiter.used == 0
+
+
+@pytest.mark.parametrize('nchunks', [2, 3, 10])
+@pytest.mark.parametrize('compact_map', [True, False])
+def test_mapreduce_pipelined(frtnd, chunk, nchunks, compact_map,
+                             oneshot_calls):
+    chunks = [chunk] * nchunks
+    result = mapreduce.mapreduce_pipelined(chunks,
+                                           'test question',
+                                           frtnd,
+                                           parallelism=4,
+                                           compact_map_mode=compact_map,
+                                           max_chunk_size=20)
+    assert isinstance(result, str)
+    assert result
+    nleaves = len(mapreduce.group_chunks_by_length([chunk] * nchunks, 20)
+                  ) if compact_map else nchunks
+    assert len(oneshot_calls) == 2 * nleaves - 1
+    # the chunks are released once mapped
+    assert chunks == []
+
+
+def test_amapreduce_parallel_executor(frtnd, chunk):
+    # all the map requests must be in flight at the same time to pass the
+    # barrier, which needs more threads than the default executor has
+    parallelism = 40
+    barrier = threading.Barrier(parallelism, timeout=10)
+    oneshot = frtnd.oneshot
+
+    def _oneshot(message: str) -> str:
+        if 'from the following file part.' in message:
+            barrier.wait()
+        return oneshot(message)
+
+    frtnd.oneshot = _oneshot
+    result = asyncio.run(
+        mapreduce.amapreduce_parallel([chunk] * parallelism,
+                                      'test question',
+                                      frtnd,
+                                      parallelism=parallelism,
+                                      compact_map_mode=False,
+                                      max_chunk_size=20))
+    assert isinstance(result, str)
+    assert not barrier.broken
+
+
+@pytest.mark.parametrize('nchunks', [2, 3, 10])
+@pytest.mark.parametrize('compact_map', [True, False])
+def test_mapreduce_streamed(frtnd, chunk, nchunks, compact_map, oneshot_calls):
+    result = mapreduce.mapreduce_streamed([chunk] * nchunks,
+                                          'test question',
+                                          frtnd,
+                                          compact_map_mode=compact_map,
+                                          max_chunk_size=20)
+    assert isinstance(result, str)
+    assert result
+    nleaves = len(mapreduce.group_chunks_by_length([chunk] * nchunks, 20)
+                  ) if compact_map else nchunks
+    assert len(oneshot_calls) == 2 * nleaves - 1
+
+
+@pytest.mark.timeout(10)
+@pytest.mark.parametrize('compact_map', [True, False])
+def test_mapreduce_streamed_map_failure(frtnd, chunk, compact_map):
+    calls = []
+    oneshot = frtnd.oneshot
+
+    def _oneshot(message: str) -> str:
+        calls.append(message)
+        if len(calls) == 2:
+            raise ValueError('map request failed')
+        return oneshot(message)
+
+    frtnd.oneshot = _oneshot
+    with pytest.raises(ValueError, match='map request failed'):
+        mapreduce.mapreduce_streamed([chunk] * 10,
+                                     'test question',
+                                     frtnd,
+                                     compact_map_mode=compact_map,
+                                     max_chunk_size=10)
+
+
+def test_drop_blank_chunks(chunk):
+    blank = chunk._replace(content=' \n\n\t\n')
+    empty = chunk._replace(content='')
+    assert mapreduce.drop_blank_chunks([blank, chunk, empty]) == [chunk]
+    assert mapreduce.drop_blank_chunks([blank, empty]) == [blank]
+
+
+def test_dedup_chunks(chunk):
+    other = chunk._replace(content='other content')
+    unique = mapreduce.dedup_chunks([chunk, other, chunk, other, chunk])
+    assert unique == [chunk, other]
+    # identical chunks of different files are all kept
+    copy = chunk._replace(path='copy')
+    assert mapreduce.dedup_chunks([chunk, copy, chunk]) == [chunk, copy]
+
+
+def test_mapreduce_super_long_context_dedup(tmpdir, frtnd, oneshot_calls):
+    text = '\n'.join(['a b c d e f g h i j k l m n o p q r s t u v w x y z'] *
+                     10)
+    with open(tmpdir / 'test.txt', 'wt') as f:
+        f.write(text)
+    kwargs = dict(spec=tmpdir.join('test.txt').strpath,
+                  max_chunk_size=60,
+                  frtnd=frtnd,
+                  user_question='test question',
+                  compact_map_mode=False,
+                  compact_reduce_mode=False)
+    # every chunk is mapped by default
+    mapreduce.mapreduce_super_long_context(**kwargs)
+    assert len(oneshot_calls) == 2 * 10 - 1
+    # the repeated chunks are skipped on request, leaving a single one
+    oneshot_calls.clear()
+    mapreduce.mapreduce_super_long_context(**kwargs, dedup=True)
+    assert oneshot_calls == []
+
+
+def test_split_batch_answer():
+    answer = 'preamble\n=== ANSWER 0 ===\nfoo\n=== ANSWER 1 ===\nbar\n'
+    assert mapreduce.split_batch_answer(answer, 2) == ['foo', 'bar']
+    # malformed answers are kept as a whole
+    assert mapreduce.split_batch_answer(answer, 3) == [answer]
+    assert mapreduce.split_batch_answer('nothing', 2) == ['nothing']
+
+
+@pytest.mark.parametrize('parallel', [1, 4])
+def test_map_batch(chunk, parallel):
+    f = frontend.EchoFrontend()
+    f.lossy_mode = False
+    f.oneshot = lambda message: '\n'.join(
+        f'=== ANSWER {i} ===\nanswer {i}'
+        for i in range(message.count('=== CHUNK ')))
+    chunks = [chunk] * 10
+    if parallel > 1:
+        results = mapreduce.map_parallel_batch(chunks,
+                                               'test question',
+                                               f,
+                                               parallelism=parallel,
+                                               batch_size=4)
+    else:
+        results = mapreduce.map_serial_batch(chunks,
+                                             'test question',
+                                             f,
+                                             batch_size=4)
+    assert results == [f'answer {i}' for i in (0, 1, 2, 3, 0, 1, 2, 3, 0, 1)]
+
+
+@pytest.mark.parametrize('parallel', [1, 4])
+@pytest.mark.parametrize('context_budget', [0, 100000])
+def test_reduce_context_budget(frtnd, parallel, context_budget, oneshot_calls):
+    results = [f'result {i}' for i in range(8)]
+    if parallel > 1:
+        result = mapreduce.reduce_parallel(results,
+                                           'test question',
+                                           frtnd,
+                                           parallelism=parallel,
+                                           context_budget=context_budget)
+    else:
+        result = mapreduce.reduce_serial(results,
+                                         'test question',
+                                         frtnd,
+                                         context_budget=context_budget)
+    assert isinstance(result, str)
+    assert len(oneshot_calls) == (1 if context_budget else 7)
+
+
+@pytest.mark.parametrize('parallel', [1, 4])
+@pytest.mark.parametrize('fanout,ncalls', [(2, 9), (4, 4), (10, 1)])
+def test_reduce_fanout(frtnd, parallel, fanout, ncalls, oneshot_calls):
+    results = [f'result {i}' for i in range(10)]
+    if parallel > 1:
+        result = mapreduce.reduce_parallel(results,
+                                           'test question',
+                                           frtnd,
+                                           parallelism=parallel,
+                                           fanout=fanout)
+    else:
+        result = mapreduce.reduce_serial(results,
+                                         'test question',
+                                         frtnd,
+                                         fanout=fanout)
+    assert isinstance(result, str)
+    # 10 -> 3 -> 1 results in 3 + 1 requests with fanout 4
+    assert len(oneshot_calls) == ncalls
+    assert all(x.count('```\n') <= 2 * fanout for x in oneshot_calls)
+
+
+def test_rate_limiter(frtnd, chunk):
+    now = [0.0]
+    limiter = mapreduce.RateLimiter(tpm=6000, clock=lambda: now[0])
+    assert limiter.reserve(6000) == 0.0
+    # 100 tokens per second are refilled
+    assert limiter.reserve(50) == 0.5
+    assert limiter.reserve(50) == 1.0
+    now[0] += 2.0
+    assert limiter.reserve(100) == 0.0
+    limited = mapreduce.RateLimitedFrontend(frtnd,
+                                            mapreduce.RateLimiter(rpm=6000))
+    assert limited.oneshot('hello') == frtnd.oneshot('hello')
+    results = mapreduce.map_parallel([chunk] * 3, 'test question', limited)
+    assert results == mapreduce.map_serial([chunk] * 3, 'test question',
+                                           frtnd)
+
+
+def test_auto_parallelism(frtnd, chunk, oneshot_calls):
+    assert mapreduce.auto_parallelism([], frtnd, 0) == (
+        mapreduce.default_parallelism(), {})
+    now = [0.0]
+    oneshot = frtnd.oneshot
+    # every request takes 0.25 seconds
+    frtnd.oneshot = lambda message: now.__setitem__(0, now[0] + 0.25) or \
+        oneshot(message)
+    prompts = [f'prompt {i}' for i in range(4)]
+    parallelism, answers = mapreduce.auto_parallelism(prompts,
+                                                      frtnd,
+                                                      240,
+                                                      clock=lambda: now[0])
+    # 4 requests per second, 0.25 seconds each, aiming at twice of 1
+    assert parallelism == min(2, mapreduce.default_parallelism())
+    assert answers == {p: oneshot(p) for p in prompts}
+    assert now[0] == 1.0
+    expected = oneshot('prompt 0')
+    oneshot_calls.clear()
+    memo = mapreduce.MemoFrontend(frtnd, answers)
+    assert memo.oneshot('prompt 0') == expected
+    assert memo.oneshot('prompt 0') == expected
+    assert oneshot_calls == ['prompt 0']
+
+
+def test_auto_parallelism_retry_transient(frtnd, monkeypatch):
+    import httpx
+    import openai
+    import tenacity
+    failures = [openai.APIConnectionError(request=httpx.Request('POST', 'x'))]
+    oneshot = frtnd.oneshot
+
+    def _flaky(message):
+        if failures:
+            raise failures.pop()
+        return oneshot(message)
+
+    frtnd.oneshot = _flaky
+    monkeypatch.setattr(
+        mapreduce, 'probe_oneshot',
+        mapreduce.probe_oneshot.retry_with(wait=tenacity.wait_none()))
+    prompts = [f'prompt {i}' for i in range(4)]
+    _, answers = mapreduce.auto_parallelism(prompts, frtnd, 600)
+    assert answers == {p: oneshot(p) for p in prompts}
+    assert not failures
+
+
+@pytest.mark.parametrize('compact_map', [True, False])
+def test_mapreduce_super_long_context_auto_parallelism(tmpdir, frtnd,
+                                                       compact_map,
+                                                       oneshot_calls):
+    text = '\n'.join(f'{i} a b c d e f g h i j k l m n o p q r s t u v w x y z'
+                     for i in range(100))
+    with open(tmpdir / 'test.txt', 'wt') as f:
+        f.write(text)
+    result = mapreduce.mapreduce_super_long_context(
+        tmpdir.join('test.txt').strpath,
+        100,
+        frtnd,
+        'test question',
+        compact_map_mode=compact_map,
+        compact_reduce_mode=False,
+        parallelism=0,
+        rpm=60000)
+    assert result
+    # the probed map requests are not asked again
+    maps = [x for x in oneshot_calls if 'from the following file part' in x]
+    assert len(maps) == len(set(maps))
+    assert len(oneshot_calls) == 2 * len(maps) - 1
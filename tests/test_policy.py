@@ -16,9 +16,86 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 import os
 import pytest
+from debgpt import policy as debian_policy
+from debgpt.cache import Cache
 from debgpt.policy import DebianPolicy
 from debgpt.policy import DebianDevref
 
+_DOCUMENT = '''Debian Policy Manual
+********************
+
+1. About this manual
+********************
+
+intro
+
+1.1. Scope
+==========
+
+scope
+
+1.2. New versions
+=================
+
+versions
+
+1.2.1. Details
+--------------
+
+details
+
+2. The Debian Archive
+*********************
+
+archive
+
+2.1. Guidelines
+===============
+
+guidelines
+'''
+
+
+@pytest.fixture
+def offline_policy(tmpdir, monkeypatch) -> DebianPolicy:
+    cache = str(tmpdir.join('cache.sqlite'))
+    monkeypatch.setattr(debian_policy, 'CACHE', cache)
+    Cache(cache)[DebianPolicy.URL] = _DOCUMENT
+    return DebianPolicy()
+
+
+def test_offline_policy(offline_policy: DebianPolicy) -> None:
+    policy = offline_policy
+    assert policy.indexes == ['1', '1.1', '1.2', '1.2.1', '2', '2.1']
+    assert str(policy) == _DOCUMENT
+    assert policy['1.1'] == '1.1. Scope\n==========\n\nscope\n'
+    # a section ends where a section of the same or a higher level starts
+    assert policy['1.2.1'] == '1.2.1. Details\n--------------\n\ndetails\n'
+    assert policy['1.2'].endswith('details\n')
+    assert policy['1'].startswith('1. About this manual\n')
+    assert policy['1'].endswith('details\n')
+    assert policy['2.1'] == '2.1. Guidelines\n===============\n\nguidelines\n'
+    assert policy['9'] == ''
+    assert policy[1] == policy['1.1']
+    assert list(policy) == [policy[x] for x in policy.indexes]
+
+
+def test_offline_policy_index_cache(offline_policy: DebianPolicy,
+                                    monkeypatch) -> None:
+    # the section index is loaded from the cache instead of scanned again
+    def _fail(self):
+        raise AssertionError('scanned again')
+
+    monkeypatch.setattr(DebianPolicy, '_DebianPolicy__scan_indexes', _fail)
+    policy = DebianPolicy()
+    assert policy.indexes == offline_policy.indexes
+    assert policy.ranges == offline_policy.ranges
+    assert policy['1.2.1'] == offline_policy['1.2.1']
+    # a changed document is scanned again
+    Cache(debian_policy.CACHE)[DebianPolicy.URL] = _DOCUMENT + '\n'
+    with pytest.raises(AssertionError, match='scanned again'):
+        DebianPolicy()
+
 
 def test_policy(tmpdir: str) -> None:
     """
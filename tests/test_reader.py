@@ -22,6 +22,7 @@ import time
 import numpy as np
 import sys
 import io
+import threading
 
 
 def test_entry2chunk():
@@ -44,6 +45,31 @@ def test_latest_file(tmpdir):
     assert reader.latest_file(files) == tmpdir.join('test2.txt')
     assert reader.latest_glob(os.path.join(
         tmpdir, 'test*.txt')) == tmpdir.join('test2.txt')
+    with open(tmpdir.join('.test3.txt'), 'wt') as f:
+        f.write('hidden\n')
+    assert reader.latest_glob(os.path.join(
+        tmpdir, 'test*.txt')) == tmpdir.join('test2.txt')
+    assert reader.latest_glob(os.path.join(
+        tmpdir, '.test*.txt')) == tmpdir.join('.test3.txt')
+    with pytest.raises(ValueError):
+        reader.latest_glob(os.path.join(tmpdir, 'void', '*.txt'))
+
+
+def test_enable_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(reader, 'CACHE', str(tmpdir.join('cache.sqlite')))
+    calls = []
+
+    @reader.enable_cache
+    def _read(spec: str) -> str:
+        calls.append(spec)
+        return spec.upper()
+
+    assert _read('a') == 'A'
+    assert _read('a') == 'A'
+    assert _read('b') == 'B'
+    assert calls == ['a', 'b']
+    # a fresh wrapper finds the result in the sqlite cache
+    assert reader.enable_cache(lambda spec: 'X')('a') == 'A'
 
 
 def test_is_text_file(tmpdir):
@@ -54,6 +80,122 @@ def test_is_text_file(tmpdir):
     with open(tmpdir.join('test.txt'), 'wt') as f:
         f.write('test test test\n')
     assert reader.is_text_file(tmpdir.join('test.txt'))
+    # a multi-byte character cut by the sniff is still text
+    with open(tmpdir.join('test.utf8'), 'wt') as f:
+        f.write('a' * (reader._SNIFF_SIZE - 1) + '\u00e9' * 10)
+    assert reader.is_text_file(tmpdir.join('test.utf8'))
+    with open(tmpdir.join('test.nul'), 'wb') as f:
+        f.write(b'test\x00test')
+    assert not reader.is_text_file(tmpdir.join('test.nul'))
+
+
+@pytest.mark.parametrize('text', [
+    '', '\n', 'a', ' a \n b\t\n\n', 'a\r\nb\r\n', 'a \u3000\nb\x0b\x0c ',
+    '  \n  ', 'a\u2028 \nb'
+])
+def test_strip_trailing_space(text: str):
+    expected = '\n'.join(x.rstrip() for x in text.split('\n'))
+    assert reader.strip_trailing_space(text) == expected
+    expected = '\n'.join(x.strip() for x in text.split('\n'))
+    assert reader.strip_space(text) == expected
+
+
+@pytest.mark.timeout(10)
+def test_strip_space_long_runs():
+    # long runs of whitespace inside a line must not take quadratic time
+    text = ('a' + ' ' * 100000 + 'b \n') * 4
+    assert reader.strip_trailing_space(text) == text.replace(' \n', '\n')
+    assert reader.strip_space(text) == text.replace(' \n', '\n')
+
+
+def test_read_file_pdf_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(reader, 'CACHE', str(tmpdir.join('cache.sqlite')))
+    calls = []
+
+    class _Page:
+
+        def extract_text(self) -> str:
+            return 'page\n'
+
+    class _PdfReader:
+
+        def __init__(self, path: str):
+            calls.append(path)
+            self.pages = [_Page(), _Page()]
+
+    pypdf = type(sys)('pypdf')
+    pypdf.PdfReader = _PdfReader
+    monkeypatch.setitem(sys.modules, 'pypdf', pypdf)
+    path = str(tmpdir.join('test.pdf'))
+    with open(path, 'wb') as f:
+        f.write(b'fake')
+    assert reader.read_file_pdf(path) == 'page\npage\n'
+    assert reader.read_file_pdf(path) == 'page\npage\n'
+    assert len(calls) == 1
+    # a modified file is read again
+    with open(path, 'wb') as f:
+        f.write(b'fake pdf')
+    assert reader.read_file_pdf(path) == 'page\npage\n'
+    assert len(calls) == 2
+
+
+def test_read_file_pdf_pages(tmpdir, monkeypatch):
+    monkeypatch.setattr(reader, 'CACHE', str(tmpdir.join('cache.sqlite')))
+
+    class _Page:
+
+        def __init__(self, i: int):
+            self.i = i
+
+        def extract_text(self) -> str:
+            return f'page{self.i}\n'
+
+    class _PdfReader:
+
+        def __init__(self, path: str):
+            self.pages = [_Page(i) for i in range(10)]
+
+    pypdf = type(sys)('pypdf')
+    pypdf.PdfReader = _PdfReader
+    monkeypatch.setitem(sys.modules, 'pypdf', pypdf)
+    monkeypatch.setattr(reader, '_PDF_PROCESS_POOL_MIN_PAGES', 3)
+    monkeypatch.setattr(reader.os, 'cpu_count', lambda: 4)
+    pools = []
+
+    def _pool(max_workers: int, mp_context):
+        # the fake module is not visible to spawned processes
+        assert mp_context.get_start_method() == 'spawn'
+        pools.append(max_workers)
+        return reader.concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    monkeypatch.setattr(reader.concurrent.futures, 'ProcessPoolExecutor',
+                        _pool)
+    expected = ''.join(f'page{i}\n' for i in range(10))
+    path = str(tmpdir.join('test.pdf'))
+    with open(path, 'wb') as f:
+        f.write(b'fake')
+    assert reader.read_file_pdf(path) == expected
+    assert pools == [3]
+    # off the main thread, e.g., in read_directory, the pages are extracted
+    # serially
+    with open(path, 'wb') as f:
+        f.write(b'fake pdf')
+    with reader.concurrent.futures.ThreadPoolExecutor(1) as executor:
+        assert executor.submit(reader.read_file_pdf,
+                               path).result() == expected
+    assert pools == [3]
+
+
+def test_read_file_newlines(tmpdir):
+    with open(tmpdir.join('test.txt'), 'wb') as f:
+        f.write(b'a\r\nb\rc\n')
+    assert reader.read_file(tmpdir.join('test.txt')) == 'a\nb\nc\n'
+    assert reader.read_file(tmpdir.join('test.txt')) == \
+        reader.read_file_plaintext(tmpdir.join('test.txt'))
+    with open(tmpdir.join('test.bin'), 'wb') as f:
+        f.write(b'\xff\xfe\x00')
+    with pytest.raises(TypeError):
+        reader.read_file(str(tmpdir.join('test.bin')))
 
 
 def test_read_pdf(tmpdir):
@@ -160,6 +302,47 @@ def test_read_directory(tmpdir):
     assert len(context) > 0
 
 
+def test_read_directory_many(tmpdir):
+    for i in range(10):
+        with open(tmpdir.join(f'test{i}.txt'), 'wt') as f:
+            f.write(f'test {i}\n')
+    with open(tmpdir.join('binary.bin'), 'wb') as f:
+        f.write(b'\xff\xfe\x00')
+    contents = reader.read_directory(str(tmpdir))
+    assert len(contents) == 11
+    for path, content in contents:
+        if path.endswith('.bin'):
+            assert content == ''
+        else:
+            assert content == f'test {path[-5]}\n'
+
+
+def test_read_and_chunk(tmpdir):
+    for i in range(3):
+        with open(tmpdir.join(f'test{i}.txt'), 'wt') as f:
+            f.write('\n'.join(f'line {i} {j}' for j in range(10)))
+    entries = reader.read(str(tmpdir))
+    chunks = reader.read_and_chunk(str(tmpdir), max_chunk_size=30)
+    expected = [x for e in entries for x in reader.chunk_entry(e, 30)]
+    assert [(x.path, x.content) for x in chunks
+            ] == [(x.path, x.content) for x in expected]
+    assert len(chunks) > len(entries)
+
+
+def test_parallel_read_many(monkeypatch):
+    # all the specs must be read at the same time to pass the barrier
+    barrier = threading.Barrier(4, timeout=10)
+
+    def fake_read_and_wrap(spec: str, **kwargs) -> str:
+        barrier.wait()
+        return f'wrapped {spec}'
+
+    monkeypatch.setattr(reader, 'read_and_wrap', fake_read_and_wrap)
+    specs = [f'spec{i}' for i in range(4)]
+    assert reader.read_many(specs) == [f'wrapped {x}' for x in specs]
+    assert reader.read_many([]) == []
+
+
 def test_read_url_file(tmpdir):
     content = 'test test test\n'
     with open(tmpdir.join('test.txt'), 'wt') as f:
@@ -298,6 +481,8 @@ def test_read_stdin(monkeypatch):
     test_input = 'test test test\ntest test test'
     monkeypatch.setattr(sys, 'stdin', io.StringIO(test_input))
     assert reader.read_stdin() == test_input
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('a \t\nb\n \n c  \n'))
+    assert reader.read_stdin() == 'a\nb\n\n c'
     # read as entries
     monkeypatch.setattr(sys, 'stdin', io.StringIO(test_input))
     contents = reader.read('stdin')
@@ -310,6 +495,10 @@ def test_read_stdin(monkeypatch):
         assert content[0] == 'stdin'
         assert content[1] in content[2](content[1])
         assert content[1] in content[3](content[1], 1, -1)
+        assert content[2](content[1]).endswith(
+            '\n```\ntest test test\ntest test test\n```\n')
+        assert content[3](content[1], 1, 2).endswith(
+            '\n```\ntest test test\ntest test test\n```\n')
     # read and wrap
     monkeypatch.setattr(sys, 'stdin', io.StringIO(test_input))
     context = reader.read_and_wrap('stdin')
@@ -346,7 +535,7 @@ def test_google_search(monkeypatch, keyword='python programming'):
 
     monkeypatch.setenv('GOOGLE_SEARCH_API_KEY', 'fake-key')
     monkeypatch.setenv('GOOGLE_SEARCH_CX', 'fake-cx')
-    monkeypatch.setattr(reader.requests, 'get', fake_get)
+    monkeypatch.setattr(reader.http_session(), 'get', fake_get)
 
     results = reader.google_search(keyword)
     assert results == [
@@ -440,6 +629,35 @@ def test_devref(section, tmpdir):
         assert content[1] in wrapped
 
 
+def test_load_policy_once(monkeypatch):
+    calls = []
+
+    class _Policy:
+
+        def __init__(self):
+            calls.append(type(self).__name__)
+            self.indexes = ['1', '2']
+
+        def __getitem__(self, index: str) -> str:
+            return f'section {index}\n'
+
+    class _Devref(_Policy):
+        pass
+
+    monkeypatch.setattr(reader.debian_policy, 'DebianPolicy', _Policy)
+    monkeypatch.setattr(reader.debian_policy, 'DebianDevref', _Devref)
+    reader._load_policy.cache_clear()
+    reader._load_devref.cache_clear()
+    try:
+        for spec in ('policy:1', 'policy:2', 'policy:', 'devref:1',
+                     'devref:'):
+            assert reader.read(spec)
+        assert calls == ['_Policy', '_Devref']
+    finally:
+        reader._load_policy.cache_clear()
+        reader._load_devref.cache_clear()
+
+
 @pytest.mark.parametrize('spec', (
     'test.txt',
     'policy:1',
@@ -473,16 +691,91 @@ def test_chunk_lines():
     chunks = reader.chunk_lines(lines, 15)
     print('chunks:', chunks)
     assert len(chunks) == 2
-    chunks_nr = reader.chunk_lines_nonrecursive(lines, 15)
-    print('chunks_nr:', chunks_nr)
-    assert len(chunks_nr) == 2
+
+    # as many lines as fit are packed into each chunk
+    chunks = reader.chunk_lines(lines, 10)
+    assert list(chunks) == [(0, 2), (2, 4), (4, 6)]
+    assert chunks[(0, 2)] == ['test', 'test']
 
     chunks = reader.chunk_lines(lines, 5)
     assert len(chunks) == 6
-    chunks_nr = reader.chunk_lines_nonrecursive(lines, 5)
-    assert len(chunks_nr) == 6
 
     chunks = reader.chunk_lines(lines, 1)
     assert len(chunks) == 6
-    chunks_nr = reader.chunk_lines_nonrecursive(lines, 1)
-    assert len(chunks_nr) == 6
+
+    chunks = reader.chunk_lines(lines, 10, 1, 4)
+    assert list(chunks) == [(1, 3), (3, 4)]
+
+    # the remaining lines fit exactly
+    chunks = reader.chunk_lines(lines, 14, 3, 6)
+    assert list(chunks) == [(3, 6)]
+
+
+@pytest.mark.parametrize('max_chunk_size', [1, 7, 8, 100])
+def test_chunk_entry(max_chunk_size: int):
+    content = 'ab\nc中\n\nd'
+    entry = reader.Entry('path', content, None,
+                         lambda x, start, end: (x, start, end))
+    chunks = reader.chunk_entry(entry, max_chunk_size)
+    assert '\n'.join(x.content for x in chunks) == content
+    spans = [x.wrapfun_chunk(x.content) for x in chunks]
+    assert spans[0][1] == 0 and spans[-1][2] == 4
+    assert all(x[2] == y[1] for x, y in zip(spans, spans[1:]))
+    if max_chunk_size >= len(content.encode()):
+        assert chunks[0].content is content
+
+
+def test_bts_offline(monkeypatch):
+    html = ('<html><body><p class="msgreceived">Received: x</p>'
+            '<pre>the bug</pre><div class="infmessage">Acknowledged</div>'
+            '<p class="infmessage">kept</p></body></html>')
+
+    class _Response:
+        text = html
+
+    monkeypatch.setattr(reader.http_session(), 'get',
+                        lambda url, timeout=None: _Response())
+    text = reader.read_bts('1056388')
+    assert 'the bug' in text and 'kept' in text
+    assert 'Received' not in text and 'Acknowledged' not in text
+    # the lines from 'Options' on are dropped from the package pages
+    html = '<pre> pkg \n bug \nOptions\n  x\n</pre>'
+    _Response.text = html
+    assert reader.read_bts('src:pkg') == 'pkg\nbug'
+
+
+def test_pdf_url_spooled(monkeypatch):
+    body = [b'%PDF-', b'fake' * 10, b'%%EOF']
+
+    class _Response:
+        status_code = 200
+
+        def iter_content(self, chunk_size: int):
+            yield from body
+
+    class _PdfReader:
+
+        def __init__(self, stream):
+            assert stream.read() == b''.join(body)
+            self.pages = []
+
+    pypdf = type(sys)('pypdf')
+    pypdf.PdfReader = _PdfReader
+    monkeypatch.setitem(sys.modules, 'pypdf', pypdf)
+    monkeypatch.setattr(reader, '_PDF_SPOOL_SIZE', 8)
+    monkeypatch.setattr(reader.http_session(), 'get',
+                        lambda url, **kwargs: _Response())
+    assert reader.read_url__requests('https://example.com/test.pdf') == ''
+
+
+def test_http_session():
+    session = reader.http_session()
+    assert session is reader.http_session()
+    adapter = session.get_adapter('https://bugs.debian.org/')
+    assert adapter._pool_maxsize == 16
+
+
+def test_byte_line_offsets():
+    content = 'a\né中\n\nb\n'
+    assert reader._byte_line_offsets(
+        content.encode()) == reader._line_offsets(content.split('\n'))